@@ -8,12 +8,34 @@ import numpy as np
 from skimage.measure import find_contours
 from scipy import interpolate
 
+from lotusvis.kernels import evaluate
+
+
+def _velocity(component):
+    """
+    Velocity component attribute that drops the gradients cached from it when it is replaced.
+    """
+    name = '_' + 'UVW'[component]
+
+    def get(self):
+        return getattr(self, name)
+
+    def set(self, value):
+        setattr(self, name, value)
+        self._gradients = {key: grad for key, grad in self._gradients.items() if key[0] != component}
+    return property(get, set)
+
 
 class AssignProps:
     """
     Read in a snapshot of a data field and output the main properties.
+    The velocity gradients are worked out once each, when first needed, and
+    everything derived from them is assembled from that cache.
     """
-    def __init__(self, snap, length_scale=1024):
+    U, V, W = _velocity(0), _velocity(1), _velocity(2)
+
+    def __init__(self, snap, length_scale=1024, axes=None):
+        self._gradients = {}
         self.snap = snap
         del snap
         
@@ -25,47 +47,133 @@ class AssignProps:
         # self.t = np.array([id*np.ones_like(self.X[0]) for id in range(self.X.shape[0])])
         del u, v, w, self.snap
         self.length_scale = length_scale
+        # 1D x, y and z of the points in units of length_scale (ReadIn.grid()), unit spacing if not given
+        self.axes = axes
     
     @property
     def magnitude(self):
-        return np.sqrt(self.Z ** 2 + self.V ** 2 + self.U ** 2)
+        return evaluate('sqrt(u**2 + v**2 + w**2)', u=self.U, v=self.V, w=self.W)
     
+    def gradient(self, f, axis):
+        """
+        Derivative of a (nt, ny, nx, nz) field along x (0), y (1) or z (2), taken on the
+        real point coordinates so it stays second order on stretched grids. A 2D field
+        (a single point along the axis) has no variation along it.
+        """
+        dim = (2, 1, 3)[axis]
+        if f.shape[dim] == 1:
+            return np.zeros_like(f)
+        edge_order = 2 if f.shape[dim] > 2 else 1
+        if self.axes is None:
+            return np.gradient(f, axis=dim, edge_order=edge_order)
+        return np.gradient(f, self.length_scale * np.asarray(self.axes[axis], dtype=np.float64), axis=dim,
+                           edge_order=edge_order)
+
+    def velocity_gradient(self, i, j):
+        """
+        d u_i / d x_j, with u_0, u_1, u_2 = U, V, W and x_0, x_1, x_2 = x, y, z, cached.
+        """
+        if (i, j) not in self._gradients:
+            self._gradients[(i, j)] = self.gradient((self.U, self.V, self.W)[i], j)
+        return self._gradients[(i, j)]
+
+    @property
+    def gradient_tensor(self):
+        """
+        The velocity gradient tensor, shape (3, 3, nt, ny, nx, nz) with [i, j] = d u_i / d x_j.
+        """
+        return np.array([[self.velocity_gradient(i, j) for j in range(3)] for i in range(3)])
+
+    def strain(self, i, j):
+        """
+        Component of the strain rate tensor, (d u_i / d x_j + d u_j / d x_i) / 2.
+        """
+        return evaluate('0.5 * (a + b)', a=self.velocity_gradient(i, j), b=self.velocity_gradient(j, i))
+
     @property
     def dudx(self):
-        dudx = np.gradient(self.U, self.length_scale*np.mean(np.diff(self.x)), axis=2, edge_order=2)
-        return dudx
+        return self.velocity_gradient(0, 0)
     
     @property
     def dudy(self):
-        dudy = np.gradient(self.U, self.length_scale*np.mean(np.diff(self.y)), axis=1, edge_order=2)
-        return dudy
+        return self.velocity_gradient(0, 1)
     
     @property
     def dvdx(self):
-        dvdx = np.gradient(self.V, self.length_scale*np.mean(np.diff(self.x)), axis=2, edge_order=2)
-        return dvdx
+        return self.velocity_gradient(1, 0)
     
     @property
     def dvdy(self):
-        dvdy = np.gradient(self.V, self.length_scale*np.mean(np.diff(self.y)), axis=1, edge_order=2)
-        return dvdy
+        return self.velocity_gradient(1, 1)
+
+    def vorticity(self, i):
+        """
+        The vorticity component about x (0), y (1) or z (2).
+        """
+        j, k = (i + 1) % 3, (i + 2) % 3
+        return evaluate('a - b', a=self.velocity_gradient(k, j), b=self.velocity_gradient(j, k))
 
     @property
     def vorticity_z(self):
-        return self.dvdx - self.dudy
+        return self.vorticity(2)
 
     @property
     def vorticity_x(self):
-        dv_dz = np.gradient(self.V, axis=2, edge_order=2)
-        dw_dy = np.gradient(self.W, axis=1, edge_order=2)
-        return dv_dz - dw_dy
+        return self.vorticity(0)
 
     @property
     def vorticity_y(self):
-        du_dz = np.gradient(self.U, axis=2, edge_order=2)
-        dw_dx = np.gradient(self.W, axis=0, edge_order=2)
-        return du_dz - dw_dx
+        return self.vorticity(1)
+
+    @property
+    def divergence(self):
+        return evaluate('a + b + c', a=self.velocity_gradient(0, 0), b=self.velocity_gradient(1, 1),
+                        c=self.velocity_gradient(2, 2))
     
+    @property
+    def q_criterion(self):
+        """
+        Q = (|Omega|^2 - |S|^2) / 2, from the invariant -sum_ij (du_i/dx_j du_j/dx_i) / 2.
+        """
+        grads = {f'g{i}{j}': self.velocity_gradient(i, j) for i in range(3) for j in range(3)}
+        return evaluate('-0.5 * (g00**2 + g11**2 + g22**2) - (g01*g10 + g02*g20 + g12*g21)', **grads)
+
+    @property
+    def lambda2(self):
+        """
+        The middle eigenvalue of S^2 + Omega^2, negative inside a vortex.
+        """
+        def middle(tensor):
+            strain, rotation = 0.5 * (tensor + tensor.swapaxes(1, 2)), 0.5 * (tensor - tensor.swapaxes(1, 2))
+            return np.linalg.eigvalsh(strain @ strain + rotation @ rotation)[:, 1]
+        return self.pointwise(middle)
+
+    @property
+    def swirling_strength(self):
+        """
+        The imaginary part of the complex conjugate eigenvalues of the velocity gradient
+        tensor, zero where they are all real.
+        """
+        return self.pointwise(lambda tensor: np.abs(np.linalg.eigvals(tensor).imag).max(axis=1))
+
+    def pointwise(self, reduce, block=2 ** 16):
+        """
+        Apply a batched reduction of 3x3 velocity gradient tensors at every point, a block of
+        points at a time so only block tensors are stacked at once.
+        :param reduce: Maps an (n, 3, 3) stack of tensors to n values.
+        :return: Array with the (nt, ny, nx, nz) layout of the velocity components.
+        """
+        grads = [[self.velocity_gradient(i, j).reshape(-1) for j in range(3)] for i in range(3)]
+        out = np.empty(grads[0][0].size, dtype=grads[0][0].dtype)
+        for start in range(0, out.size, block):
+            points = slice(start, min(start + block, out.size))
+            tensor = np.empty((points.stop - points.start, 3, 3))
+            for i in range(3):
+                for j in range(3):
+                    tensor[:, i, j] = grads[i][j][points]
+            out[points] = reduce(tensor)
+        return out.reshape(self.velocity_gradient(0, 0).shape)
+
     def boundary_coords(self, contour=1.):
         """
         Takes in the contour level, which is a contour of the distance function.
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Jonathan Massey
+@description: Work out derived fields of runs too big for memory, a block at a time
+@contact: masseyjmo@gmail.com
+"""
+import numpy as np
+from tqdm import tqdm
+
+import lotusvis.io as io
+from lotusvis.assign_props import AssignProps
+
+# Roughly how many copies of a velocity component a block needs: the inputs, the cached gradients and the result
+WORKING_COPIES = 16
+
+
+def blocks(shape, itemsize, nbytes=2 ** 28, halo=1):
+    """
+    Split an (nt, ny, nx, nz) array into blocks that fit in about nbytes of working memory:
+    a few snapshots at a time, or if one snapshot is too big, slabs along its longest spatial
+    axis with halo points either side. Slabs are at least two points thick, so with the
+    halo a derivative never runs out of points for its stencil.
+    :return: Generator of (read, keep, write): the index of the block to read including its
+             halo, the part of that block to keep, and where the kept part goes in the output.
+    """
+    nt, space = shape[0], shape[1:]
+    points = max(1, nbytes // (itemsize * WORKING_COPIES))
+    per_snap = int(np.prod(space))
+    if per_snap <= points:
+        step = max(1, points // per_snap)
+        for t0 in range(0, nt, step):
+            index = (slice(t0, min(t0 + step, nt)),) + (slice(None),) * 3
+            yield index, (slice(None),) * 4, index
+        return
+    axis = 1 + int(np.argmax(space))
+    n = shape[axis]
+    step = max(2, points * n // per_snap)
+    starts = list(range(0, n, step))
+    if len(starts) > 1 and n - starts[-1] < 2:
+        starts.pop()
+    for t in range(nt):
+        for idx, lo in enumerate(starts):
+            hi = starts[idx + 1] if idx + 1 < len(starts) else n
+            lo_halo, hi_halo = max(0, lo - halo), min(n, hi + halo)
+            read = [slice(t, t + 1)] + [slice(None)] * 3
+            write, keep = list(read), [slice(None)] * 4
+            read[axis], write[axis] = slice(lo_halo, hi_halo), slice(lo, hi)
+            keep[axis] = slice(lo - lo_halo, hi - lo_halo)
+            yield tuple(read), tuple(keep), tuple(write)
+
+
+def derived_field(snaps, quantity, out=None, axes=None, length_scale=1, fields='uvwp', nbytes=2 ** 28, region=None):
+    """
+    Work out an AssignProps quantity, e.g. 'vorticity_z' or 'q_criterion', over snapshots that
+    don't fit in memory. Each block is read with a one point halo and differentiated with the
+    usual second order stencils, so only the true domain edges use the one-sided edge_order=2
+    formulas and the result matches the whole array done at once.
+    :param snaps: (nt, fields, ny, nx, nz) array-like such as a memmap from ReadIn.stream_snaps,
+                  or an open SnapStore/CompressedStore.
+    :param quantity: Name of an AssignProps property, or a callable taking an AssignProps.
+    :param out: (nt, ny, nx, nz) array-like to write into, e.g. a memmap or a h5py dataset. A str
+                is taken as the path of a new .npy to memory map. In memory if None.
+    :param axes: 1D x, y and z of the points in units of length_scale, see ReadIn.grid.
+    :param fields: The variables held along the second axis of snaps, if it isn't a store.
+    :param region: (y, x, z) slices of a store to work on, e.g. ReadIn.store_region, the whole store if None.
+    :return: out.
+    """
+    store = hasattr(snaps, 'read') and hasattr(snaps, 'fields')
+    fields = io.check_fields(snaps.fields if store else fields)
+    velocity = [field for field in 'uvw' if field in fields]
+    # The stored indices of every point worked on, so a block can be read straight out of the region
+    points = [range(n) for n in snaps.shape[-3:]]
+    if store and region is not None:
+        points = [axis[index] for axis, index in zip(points, region)]
+    shape = (snaps.shape[0] if not store else len(snaps),) + tuple(len(axis) for axis in points)
+    dtype = np.dtype(snaps.dtype)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    compute = quantity if callable(quantity) else (lambda props: getattr(props, quantity))
+
+    for read, keep, write in tqdm(list(blocks(shape, dtype.itemsize, nbytes))):
+        if store:
+            block = snaps.read(read[0], ''.join(velocity), tuple(_slice(axis[index]) for axis, index in zip(points, read[1:])))
+        else:
+            block = np.stack([np.asarray(snaps[(read[0], fields.index(field)) + read[1:]]) for field in velocity], axis=1)
+        # AssignProps expects u, v, w and p along the second axis, the missing ones are zero
+        full = np.zeros((block.shape[0], 4) + block.shape[2:], dtype=block.dtype)
+        for idx, field in enumerate(velocity):
+            full[:, 'uvw'.index(field)] = block[:, idx]
+        block_axes = None
+        if axes is not None:
+            block_axes = tuple(np.asarray(axis)[read[dim]] for axis, dim in zip(axes, (2, 1, 3)))
+        out[write] = compute(AssignProps(full, length_scale, block_axes))[keep]
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def _slice(points):
+    """
+    The slice picking out a range of indices.
+    """
+    if not len(points):
+        return slice(0, 0)
+    return slice(points[0], points[-1] + 1, points.step)
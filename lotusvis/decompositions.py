@@ -5,42 +5,139 @@
               Eventually I hope to integrate this with some DMD and POD decompositions.
 @contact: jmom1n15@soton.ac.uk
 """
-import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
+from scipy.signal import hilbert
 
 import lotusvis.io as io
+import lotusvis.snap_iterator as snap_iterator
 from lotusvis.flow_field import ReadIn
 from tqdm import tqdm
 
 
 class Decompositions(ReadIn):
     def __init__(self, sim_dir, fn_root, length_scale, ext='vti', **kwargs):
-        super().__init__(sim_dir, fn_root, length_scale, ext)
+        super().__init__(sim_dir, fn_root, length_scale, ext, **kwargs)
 
-    def phase_average(self, t):
+    def phase_average(self, t=None, period=None, n_bins=None, t0=None, fields='uvwp', workers=1, force=None,
+                      method='hilbert', time_scale=1.):
         """
-        The first dimension will be the number of snapshots. We need
-        to know how many phases we've averaged over as the data doesn't
-        contain any time info
-        :param t: Number of convection cycles
-        :return: phase average with n/
+        Average the snapshots at each phase of a cycle. Either split the run into t cycles
+        by counting snapshots, bin the snapshots on their .pvd times with a known period, or
+        bin them on the instantaneous phase of a fort.9 column when the period drifts.
+        :param t: Number of convection cycles, assuming evenly spaced output and a whole number of cycles.
+        :param period: The period in .pvd time units, to bin on ((time - t0) / period) mod 1 instead.
+        :param n_bins: Number of phase bins to use with a period or a force.
+        :param t0: Time of zero phase, the first snapshot's by default.
+        :param workers: Split the run into this many segments accumulated on threads, see binned_average.
+        :param force: Name of the fort.9 column to take the phase from, see force_phase_bins.
+        :param method: 'hilbert' or 'crossings', see instantaneous_phase.
+        :param time_scale: Multiply the fort.9 times by this to get the .pvd times.
+        :return: phase average of shape (bins, fields, ny, nx, nz), NaN in a bin no snapshot fell in.
         """
-        # self.fns = self.fns[len(self.fns)//2:]
-        n_phase_snaps = len(self.fns) // t
-        # Get the shape to initialise the array (important for efficiency)
-        phase_average = np.zeros(self.init_phase_average_array(t))
-        for idx, fn in tqdm(enumerate(self.fns), total=len(self.fns)):
-            # TODO: Make the vti vtr distinction
-            snap = io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale)
-            # Start with zeros and build up the cumulative sum
-            phase_average[int(idx % n_phase_snaps)] = phase_average[int(idx % n_phase_snaps)] + snap
-        phase_average = phase_average/t
-        return phase_average
+        if period is None and force is None:
+            n_bins = len(self.fns) // t
+            bins = np.arange(len(self.fns)) % n_bins
+        elif n_bins is None:
+            raise ValueError('Binning on a period or a force needs n_bins')
+        elif force is not None:
+            bins = self.force_phase_bins(force, n_bins, method, time_scale)
+        else:
+            bins = self.phase_bins(period, n_bins, t0)
+        return self.binned_average(bins, n_bins, fields, workers)[0]
+
+    def phase_bins(self, period, n_bins, t0=None):
+        """
+        The phase bin of each of fns from its .pvd time.
+        :return: int array, one bin per snapshot.
+        """
+        times = self.sorted_times()
+        t0 = times[0] if t0 is None else t0
+        return phase_bin((self.times - t0) / period, n_bins)
+
+    def force_phase_bins(self, column, n_bins, method='hilbert', time_scale=1.):
+        """
+        The phase bin of each of fns from the instantaneous phase of a fort.9 column, e.g. the
+        lift, interpolated to its .pvd time. Zero phase is where the force crosses its mean going up.
+        :return: int array, one bin per snapshot, -1 for those outside the force history.
+        """
+        self.sorted_times()
+        data = self.force_history().data
+        logged = data['t'] * time_scale
+        phase = instantaneous_phase(logged, data[column], method)
+        return phase_bin(np.interp(self.times, logged, phase, left=np.nan, right=np.nan), n_bins)
+
+    def binned_average(self, bins, n_bins, fields='uvwp', workers=1):
+        """
+        Average the snapshots in each bin in one streaming pass. The run is split into
+        segments read on threads, each keeping float64 sums and counts per bin that are
+        added together at the end, so a worker holds n_bins snapshots' worth of sums.
+        :param bins: The bin of each of fns, negative to leave a snapshot out.
+        :return: The (n_bins, fields, ny, nx, nz) averages and the number of snapshots in each bin.
+        """
+        bins = np.asarray(bins, dtype=int)
+        shape = (n_bins,) + self.init_snap_array(fields)[1:]
+
+        def accumulate(idx):
+            sums, counts = np.zeros(shape, dtype=io.ACCUMULATOR_DTYPE), np.zeros(n_bins, dtype=np.int64)
+            idx = idx[bins[idx] >= 0]
+            with snap_iterator.Prefetch([self.fns[i] for i in idx], partial(self.read_snap, fields=fields)) as reads:
+                for b, snap in tqdm(zip(bins[idx], reads), total=len(idx), disable=workers > 1):
+                    sums[b] += snap
+                    counts[b] += 1
+            return sums, counts
+
+        segments = [idx for idx in np.array_split(np.arange(len(self.fns)), workers) if len(idx)]
+        if workers == 1:
+            sums, counts = accumulate(np.arange(len(self.fns)))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                parts = pool.map(accumulate, segments)
+                sums, counts = next(parts)
+                for part_sums, part_counts in parts:
+                    sums += part_sums
+                    counts += part_counts
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sums /= counts.reshape((-1,) + (1,) * (sums.ndim - 1))
+        return sums.astype(self.dtype), counts
 
     def init_phase_average_array(self, t):
         n_phase_snaps = len(self.fns) // t
-        snapshot_shape = np.shape(io.read_vti(os.path.join(self.datp_dir, self.fns[0]), self.length_scale))
+        snapshot_shape = self.init_snap_array()[1:]
         return (n_phase_snaps,) + snapshot_shape
 
-    
+
+def phase_bin(phase, n_bins):
+    """
+    Bin phases given in cycles, of which only the fractional part counts, into n_bins. NaN goes in bin -1.
+    """
+    phase = np.asarray(phase, dtype=float)
+    bins = np.full(phase.shape, -1)
+    known = np.isfinite(phase)
+    bins[known] = np.minimum((np.mod(phase[known], 1.) * n_bins).astype(int), n_bins - 1)
+    return bins
+
+
+def instantaneous_phase(t, signal, method='hilbert'):
+    """
+    The unwrapped phase of an oscillating signal in cycles, zero where it crosses its mean going up.
+    :param method: 'hilbert' for the angle of the analytic signal, after resampling the signal evenly
+                   in time, or 'crossings' to go linearly in time from one upward crossing of the mean
+                   to the next, which is NaN before the first crossing and after the last.
+    :return: The phase at each of t.
+    """
+    t, signal = np.asarray(t, dtype=float), np.asarray(signal, dtype=float)
+    signal = signal - signal.mean()
+    if method == 'hilbert':
+        even = np.linspace(t[0], t[-1], len(t))
+        analytic = hilbert(np.interp(even, t, signal))
+        return np.interp(t, even, (np.unwrap(np.angle(analytic)) + np.pi / 2) / (2 * np.pi))
+    if method == 'crossings':
+        up = np.flatnonzero((signal[:-1] < 0) & (signal[1:] >= 0))
+        if len(up) < 2:
+            raise ValueError('The signal needs at least two upward crossings of its mean')
+        crossings = t[up] - signal[up] * (t[up + 1] - t[up]) / (signal[up + 1] - signal[up])
+        return np.interp(t, crossings, np.arange(len(crossings)), left=np.nan, right=np.nan)
+    raise ValueError(f"Unknown method {method}, use 'hilbert' or 'crossings'")
@@ -7,13 +7,14 @@
 import numpy as np
 
 from lotusvis.flow_field import ReadIn
+from lotusvis.kernels import evaluate
 
 
 class Calculations(ReadIn):
 
     @property
     def magnitude(self):
-        return np.sqrt(self.Z ** 2 + self.V ** 2 + self.U ** 2)
+        return evaluate('sqrt(u**2 + v**2 + w**2)', u=self.U, v=self.V, w=self.W)
 
     @property
     def vorticity_z(self):
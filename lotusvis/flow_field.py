@@ -9,13 +9,18 @@ from genericpath import exists
 from itertools import count
 import os
 import time
-from tkinter import Tcl
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 from tqdm import tqdm
 import lotusvis.io as io
+from lotusvis import blocked, logs, parallel
+from lotusvis.kernels import evaluate
+from lotusvis.statistics import StreamingStats
 import lotusvis.snap_iterator as snap_iterator
 from lotusvis.assign_props import AssignProps
+from lotusvis.save import CompressedStore, SnapStore, open_store
 
 
 class ReadIn:
@@ -28,163 +33,440 @@ class ReadIn:
         self.datp_dir = os.path.join(sim_dir, 'datp')
         self.length_scale = length_scale
         self.ext = ext
+        # ((xmin, xmax), (ymin, ymax)[, (zmin, zmax)]) in units of length_scale to crop every read to
+        self.window = kwargs.get('window', None)
+        # (sx, sy, sz) decimation, e.g. 4 to read every 4th point along each axis for quick looks
+        self.stride = io.check_stride(kwargs.get('stride', None))
+        self._fns, self.header, self.pvd_times = None, None, {}
+        self.times, self.time_order = None, None
+        self.snap_store, self.store_region = None, None
+        self.force_log = None
+        if kwargs.get('use_store', True):
+            for path in (self.store_path(), self.store_path(compressed=True)):
+                if exists(path) and self.snap_store is None:
+                    self.attach_store(open_store(path))
 
     @property
     def fns(self):
-        fns = [fn for fn in os.listdir(self.datp_dir) if fn.startswith(self.fn_root) and fn.endswith(f'.p{self.ext}')]
-        fns = Tcl().call('lsort', '-dict', fns)
-        return fns
+        if self._fns is None:
+            self.refresh_index()
+        return self._fns
 
     @fns.setter
     def fns(self, value):
-        self.fns = value
-    
+        if self._fns is None:
+            self.refresh_index()
+        self._fns = list(value)
+        self.index_times()
+
+    def refresh_index(self):
+        """
+        Scan the datp folder once and cache the naturally ordered file list, the output
+        time of each file from the .pvd, and the grid layout (whole extent, origin,
+        spacing and pieces) of the first snapshot. Call again to see new output.
+        """
+        fns = [fn for fn in os.listdir(self.datp_dir) if fn.startswith(self.fn_root) and fn.endswith(f'.p{self.ext}')]
+        self._fns = sorted(fns, key=io.natural_key)
+        pvd = os.path.join(self.sim_dir, f'{self.fn_root}.{self.ext}.pvd')
+        self.pvd_times = io.read_pvd(pvd) if exists(pvd) else {}
+        self.index_times()
+        if self._fns:
+            self.header = io.read_pvti_header(os.path.join(self.datp_dir, self._fns[0]))
+            if self.header['rectilinear']:
+                self.header['axes'] = io.rectilinear_axes(self.header)
+
+    @property
+    def dtype(self):
+        """
+        The precision the snapshots are written, stored and passed around in.
+        """
+        if self._fns is None:
+            self.refresh_index()
+        return self.header['dtype'] if self.header is not None else io.STORAGE_DTYPE
+
+    def index_times(self):
+        """
+        Line the .pvd times up with fns, and sort them once for the binary searches below.
+        """
+        self.times = np.array([self.pvd_times.get(fn, np.nan) for fn in self._fns])
+        self.time_order = np.argsort(self.times, kind='stable')
+
+    def sorted_times(self):
+        if self._fns is None:
+            self.refresh_index()
+        if np.isnan(self.times).any():
+            raise ValueError(f'Not every snapshot has a time in {self.fn_root}.{self.ext}.pvd')
+        return self.times[self.time_order]
+
+    def nearest_snap(self, t):
+        """
+        The snapshot written closest to time t. Times are in the units Lotus writes to the .pvd.
+        :param t: A time, or an array of times.
+        :return: The file name, or a list of them.
+        """
+        times = self.sorted_times()
+        ts = np.asarray(t, dtype=float)
+        right = np.clip(np.searchsorted(times, ts), 0, len(times) - 1)
+        left = np.clip(right - 1, 0, len(times) - 1)
+        idx = np.where(np.abs(ts - times[left]) <= np.abs(times[right] - ts), left, right)
+        if np.ndim(idx) == 0:
+            return self.fns[self.time_order[idx]]
+        return [self.fns[i] for i in self.time_order[idx]]
+
+    def snaps_between(self, t0, t1):
+        """
+        The snapshots written in [t0, t1], e.g. to drop the initial transient with
+        sim.fns = sim.snaps_between(t0, np.inf).
+        """
+        times = self.sorted_times()
+        lo, hi = np.searchsorted(times, t0, side='left'), np.searchsorted(times, t1, side='right')
+        return [self.fns[i] for i in self.time_order[lo:hi]]
+
+    def snaps_every(self, dt, t0=None, t1=None):
+        """
+        The snapshots closest to every dt in time (e.g. every convective time) between t0 and t1.
+        """
+        times = self.sorted_times()
+        t0 = times[0] if t0 is None else max(t0, times[0])
+        t1 = times[-1] if t1 is None else min(t1, times[-1])
+        fns = self.nearest_snap(np.arange(t0, t1 + dt / 2, dt))
+        return list(dict.fromkeys(fns))
+
     def snap_iterator(self):
         return snap_iterator.Fn(self.fns)
 
-    def next_snap(self):
+    def read_snap(self, fn, fields='uvwp'):
+        """
+        Read a single snapshot from the datp folder, cropped to the window if there is one.
+        :param fn: The .pvti file name.
+        :param fields: The variables to read, any of 'u', 'v', 'w' and 'p'.
+        :return: Array of shape (len(fields), ny, nx, nz).
+        """
+        store = self.snap_store
+        if store is not None and fn in store.index and set(io.check_fields(fields)) <= set(store.fields):
+            return store.read(store.index[fn], fields, self.store_region)
+        return self.read_source(fn, fields)
+
+    def read_source(self, fn, fields='uvwp', decimate=True, extent=None):
+        """
+        Read a snapshot from its .pvti (or .pvtr), bypassing the store.
+        :param decimate: Apply the stride, the stores are always written at full resolution.
+        :param extent: Read this index extent rather than the window's, e.g. the one a store holds.
+        """
+        stride = self.stride if decimate else None
+        if self.ext == 'vtr':
+            if self._fns is None:
+                self.refresh_index()
+            return io.read_vtr(os.path.join(self.datp_dir, fn), self.length_scale, fields=fields, window=self.window,
+                               axes=self.header['axes'], stride=stride, extent=extent)[0]
+        return io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale, fields=fields, window=self.window,
+                           stride=stride, extent=extent)
+
+    def read_span(self, fn, fields='uvwp', rms=False):
+        """
+        The span average of a 3D snapshot, reduced piece by piece as it is read so the
+        3D field is never held. Always reads the .pvti (or .pvtr), not the store.
+        :param rms: Also return the spanwise RMS.
+        :return: Array of shape (len(fields), ny, nx), or (mean, rms) with rms.
+        """
+        if self._fns is None:
+            self.refresh_index()
+        return io.read_span(os.path.join(self.datp_dir, fn), self.length_scale, fields=fields, window=self.window,
+                            rms=rms, axes=self.header.get('axes'), stride=self.stride)
+
+    def span_snaps(self, fields='uvwp', rms=False, prefetch=2):
+        """
+        Iterator over the span averaged snapshots, read ahead on worker threads.
+        """
+        with snap_iterator.Prefetch(self.fns, partial(self.read_span, fields=fields, rms=rms), prefetch) as spans:
+            yield from spans
+
+    def forces(self, time_scale=1.):
+        """
+        The fort.9 force history interpolated onto the snapshot times, parsing only
+        what the solver has appended since the last call.
+        :param time_scale: Multiply the fort.9 times by this to get the .pvd times.
+        :return: Structured array with a row per snapshot in fns order, NaN outside the history.
+        """
+        if self._fns is None:
+            self.refresh_index()
+        return logs.align(self.force_history().data, self.times, time_scale=time_scale)
+
+    def force_history(self):
+        """
+        The fort.9 Log, kept between calls and brought up to date with what the solver has appended.
+        """
+        if self.force_log is None:
+            self.force_log = logs.force_history(self.sim_dir)
+        else:
+            self.force_log.refresh()
+        return self.force_log
+
+    def extent(self):
+        """
+        The index extent of the (windowed) snapshots.
+        """
+        if self._fns is None:
+            self.refresh_index()
+        if self.window is not None:
+            return io.window_extent(self.header, self.window, self.length_scale)
+        return self.header['whole_extent']
+
+    def grid(self):
+        """
+        The 1D x, y and z coordinates of the (windowed) snapshots, in units of length_scale.
+        On a stretched grid these are the coordinates written in the .vtr pieces.
+        With a stride only every (sx, sy, sz)th coordinate is kept.
+        """
+        extent = self.extent()
+        return io.extent_axes(extent, self.header, self.length_scale, self.stride)
+
+    def store_path(self, save_path=None, compressed=False):
+        return os.path.join(save_path or self.datp_dir, f'{self.fn_root}.zst.h5' if compressed else f'{self.fn_root}.h5')
+
+    def store(self, save_path=None, fields='uvwp', refresh=True, compressed=False, **codec):
+        """
+        The chunked HDF5 store of every snapshot, written on first use. Once attached,
+        read_snap and everything built on it reads from the store instead of the .pvti files.
+        :param save_path: Folder holding the store, the datp folder by default.
+        :param refresh: Add the snapshots written (or rewritten) since the store was made.
+        :param compressed: Use the zstandard CompressedStore instead of raw float32.
+        :param codec: Options for a new CompressedStore, e.g. level, shuffle and tolerance.
+        :return: The open SnapStore. Raises ValueError if an existing store can't serve this ReadIn.
+        """
+        path = self.store_path(save_path, compressed)
+        if not exists(path):
+            self.write_store(path, fields, CompressedStore if compressed else SnapStore, **codec)
+        elif refresh:
+            self.refresh_store(path)
+        if self.snap_store is None or self.snap_store.path != path:
+            if self.snap_store is not None:
+                self.snap_store.close()
+            self.attach_store(open_store(path), fields)
+            if self.snap_store is None:
+                raise ValueError(f'{path} does not cover the window or hold the fields {fields}, '
+                                 f'remove it or give another save_path')
+        return self.snap_store
+
+    def refresh_store(self, path):
+        """
+        Convert only the snapshots missing from the store or whose files have changed
+        since, going by the size and mtime in the store's manifest.
+        :return: The file names that were (re)converted.
+        """
+        if self.snap_store is not None and self.snap_store.path == path:
+            self.snap_store.close()
+            self.snap_store, self.store_region = None, None
+        self.refresh_index()
+        with open_store(path, 'r+') as store:
+            manifest = store.manifest
+            stats = {fn: io.snapshot_stat(os.path.join(self.datp_dir, fn)) for fn in self.fns}
+            stale = [fn for fn in self.fns if manifest.get(fn) != stats[fn]]
+            # Whatever the window of this ReadIn, the store is refreshed over the extent it was written with
+            extent = tuple(int(v) for v in store.attrs['whole_extent'])
+            reads = snap_iterator.Prefetch(stale, partial(self.read_source, fields=store.fields, decimate=False,
+                                                          extent=extent))
+            with reads:
+                for fn, snap in tqdm(zip(stale, reads), total=len(stale)):
+                    if fn in store.index:
+                        store.write(store.index[fn], snap, stats[fn])
+                    else:
+                        store.append(snap, fn, stats[fn])
+        return stale
+
+    def attach_store(self, store, fields=None):
+        """
+        Read snapshots from the store if it covers the (windowed) domain, and holds the fields
+        if any are given, otherwise close it. read_snap still reads the fields a store doesn't
+        hold from the .pvti files.
+        """
+        try:
+            if fields is not None and not set(io.check_fields(fields)) <= set(store.fields):
+                raise ValueError(f'{store.path} holds {store.fields}, not {fields}')
+            self.store_region = store.region(self.extent(), stride=self.stride)
+            self.snap_store = store
+        except ValueError:
+            store.close()
+            self.snap_store, self.store_region = None, None
+
+    def write_store(self, path, fields='uvwp', store_class=SnapStore, **codec):
+        """
+        Stream the snapshots into a new store one at a time, so memory use stays at a few snapshots.
+        """
+        extent = self.extent()
+        if self.header['rectilinear']:
+            grid = dict(zip('xyz', io.extent_axes(extent, self.header, 1)))
+        else:
+            grid = {'origin': self.header['origin'], 'spacing': self.header['spacing']}
+        store = store_class.create(path, io.extent_shape(extent), fields, self.dtype, whole_extent=extent,
+                                   length_scale=self.length_scale, **grid, **codec)
+        stats = [io.snapshot_stat(os.path.join(self.datp_dir, fn)) for fn in self.fns]
+        reads = snap_iterator.Prefetch(self.fns, partial(self.read_source, fields=fields, decimate=False))
+        with store, reads:
+            for fn, stat, snap in tqdm(zip(self.fns, stats, reads), total=len(self.fns)):
+                store.append(snap, fn, stat)
+
+    def prefetch_snaps(self, fields='uvwp', depth=2):
+        """
+        Iterator over all the snapshots that reads ahead on background threads.
+        :param fields: The variables to read, any of 'u', 'v', 'w' and 'p'.
+        :param depth: How many snapshots to read ahead of the consumer.
+        """
+        return snap_iterator.Prefetch(self.fns, partial(self.read_snap, fields=fields), depth=depth)
+
+    def next_snap(self, fields='uvwp', prefetch=2):
         """
         Iterator that gets the next timestep and returns a snap.
+        :param fields: The variables to read, any of 'u', 'v', 'w' and 'p'.
+        :param prefetch: How many snapshots to read ahead in the background, 0 reads synchronously.
         """
-        for n_fn in self.snap_iterator():
-            snap = io.read_vti(os.path.join(self.datp_dir, n_fn), self.length_scale)
-            yield snap.reshape(1, *np.shape(snap))
+        if not prefetch:
+            for n_fn in self.snap_iterator():
+                snap = self.read_snap(n_fn, fields=fields)
+                yield snap.reshape(1, *np.shape(snap))
+            return
+        with self.prefetch_snaps(fields, prefetch) as snaps:
+            for snap in snaps:
+                yield snap.reshape(1, *np.shape(snap))
 
-    def snaps(self, save=True, part=True, save_path=None):
+    def snaps(self, save=True, part=True, save_path=None, stream=False):
         """
         This function reads in the data from the paraview files saves as an binary, and
         returns a numpy array of the data.
-        :param save: If true, the data will be saved as a binary file.
+        :param save: If true, the data will be saved as a binary file. The full run
+                     is streamed into the chunked HDF5 store, see store.
         :param part: If true, only the first snapshot will be saved.
-        :return: A numpy array of the data.
+        :param stream: If true, write the full run straight into fluid.npy one snapshot
+                       at a time and return it memory mapped, see stream_snaps. This is also
+                       what happens when the run doesn't fit in memory.
+        :return: A numpy array of the data, memory mapped if it was streamed.
         """
+        npy = os.path.join(save_path or self.datp_dir, f'{self.fn_root}.npy')
         try:
             if part and exists(os.path.join(self.datp_dir, f'{self.fn_root}-part.npy')):
                 snaps = np.load(os.path.join(self.datp_dir, f'{self.fn_root}-part.npy'))
-            elif not part and exists(os.path.join(self.datp_dir, f'{self.fn_root}.npy')):
-                snaps = np.load(os.path.join(self.datp_dir, f'{self.fn_root}.npy'))
+            elif not part and exists(npy):
+                snaps = np.load(npy, mmap_mode='r')
             elif part:
-                snap = io.read_vti(os.path.join(self.datp_dir, self.fns[0]), self.length_scale)
+                snap = self.read_snap(self.fns[0])
                 snaps = snap.reshape(1, *np.shape(snap))
                 if save:
                     np.save(os.path.join(self.datp_dir, f'{self.fn_root}-part.npy'), snaps)
+            elif stream:
+                snaps = self.stream_snaps(npy)
+            elif save:
+                snaps = self.store(save_path).read(region=self.store_region)
             else:
-                snaps = np.empty(self.init_snap_array())
-                for idx, fn in tqdm(enumerate(self.fns)):
-                    snap = io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale)
-                    snaps[idx] = np.array(snap)
-                    del snap
-                if save:
-                    if save_path is not None:
-                        np.save(os.path.join(save_path, f'{self.fn_root}.npy'), snaps)
-                    else:
-                        np.save(os.path.join(self.datp_dir, f'{self.fn_root}.npy'), snaps)
+                snaps = np.empty(self.init_snap_array(), dtype=self.dtype)
+                with self.prefetch_snaps() as prefetch:
+                    for idx, snap in tqdm(enumerate(prefetch), total=len(self.fns)):
+                        snaps[idx] = snap
             return snaps
         except MemoryError:
-            print('Not enough memory to load all the data, at once saving individual time steps as binary and trying again')
-            try:
-                for idx, fn in tqdm(enumerate(self.fns)):
-                    snap = io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale)
-                    np.save(os.path.join(self.datp_dir, f'{self.fn_root}{idx}.npy'), snap)
-                    del snap
-            except MemoryError:
-                print('Not enough memory to load a single time step. Bigger machine?')
+            print('Not enough memory to load all the data at once, streaming it to disk instead')
+            return self.stream_snaps(npy)
 
-    def save_vorticity_field(self, save_path="None"):
+    def stream_snaps(self, path, fields='uvwp', transform=None, shape=None):
         """
-        This function reads in the data from the paraview files saves as an binary, and
-        returns a numpy array of just the vorticity field.
-        :param save: If true, the data will be saved as a binary file.
-        :param part: If true, only the first snapshot will be saved.
-        :return: A numpy array of the data.
+        Write the snapshots one at a time into a preallocated .npy, so memory use stays
+        at a few snapshots however long the run is.
+        :param path: The .npy to write.
+        :param fields: The variables to read, any of 'u', 'v', 'w' and 'p'.
+        :param transform: Applied to each (1, fields, ny, nx, nz) snapshot before it is
+                          written, e.g. to keep only the vorticity.
+        :param shape: The shape of a transformed snapshot, that of the snapshot by default.
+        :return: The written (nt, ...) array, memory mapped read-only.
         """
-        try:
-            snaps = np.empty(self.init_snap_array())
-            for idx, fn in tqdm(enumerate(self.fns)):
-                snap = io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale)
-                snaps[idx] = np.array(snap)
-                del snap
-            snaps = AssignProps(snaps, self.length_scale).vorticity_z
-            if save_path != "":
-                np.save(os.path.join(save_path, f'{self.fn_root}_vortz.npy'), snaps)
-            else:
-                np.save(os.path.join(self.datp_dir, f'{self.fn_root}_vortz.npy'), snaps)
-            print('Vorticity field saved')
-            return snaps
-        except MemoryError:
-            print('Not enough memory to load all the data, at once saving individual time steps as binary and trying again')
-            try:
-                self.vort_low_memory_saver(save_path)
-            except MemoryError:
-                print('Not enough memory to load a single time step. Bigger machine?')
+        shape = self.init_snap_array(fields) if shape is None else (len(self.fns),) + tuple(shape)
+        out = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=shape)
+        for idx, snap in tqdm(enumerate(self.next_snap(fields)), total=len(self.fns)):
+            out[idx] = snap[0] if transform is None else transform(snap)[0]
+        out.flush()
+        del out
+        return np.load(path, mmap_mode='r')
+
+    def derived_field(self, quantity, out=None, snaps=None, nbytes=2 ** 28):
+        """
+        An AssignProps quantity over the whole run, worked out a block at a time so it
+        needn't fit in memory, see blocked.derived_field.
+        :param quantity: e.g. 'vorticity_z', 'q_criterion' or 'magnitude'.
+        :param out: Array-like or path of a .npy to write into, in memory if None.
+        :param snaps: The snapshots to work from, by default the store (written if need be), read
+                      through the window and stride of this ReadIn. Arrays should be laid out as
+                      read_snap reads them, e.g. from stream_snaps.
+        :return: out, shape (nt, ny, nx, nz).
+        """
+        snaps = self.store() if snaps is None else snaps
+        region = self.store_region if snaps is self.snap_store else None
+        return blocked.derived_field(snaps, quantity, out, self.grid(), self.length_scale, nbytes=nbytes, region=region)
+
+    def derived_snaps(self, quantity, out_path=None, workers=None):
+        """
+        An AssignProps quantity of every snapshot, worked out on a pool of processes that
+        get the snapshots through shared memory, see parallel.derived_fields.
+        :param quantity: e.g. 'vorticity_z', 'q_criterion' or 'magnitude'.
+        :param out_path: The .npy to write, {fn_root}_{quantity}.npy in the datp folder by default.
+        :param workers: Number of processes, all the cores by default.
+        :return: The results, shape (nt, ny, nx, nz), memory mapped.
+        """
+        out_path = out_path or os.path.join(self.datp_dir, f'{self.fn_root}_{quantity}.npy')
+        return parallel.derived_fields(self, quantity, out_path, workers)
+
+    def save_vorticity_field(self, save_path=None):
+        """
+        This function reads in the data from the paraview files, and streams just the
+        vorticity field into a binary one snapshot at a time.
+        :param save_path: Folder to save {fn_root}_vortz.npy in, the datp folder by default.
+        :return: The vorticity field, memory mapped.
+        """
+        snaps = self.stream_snaps(os.path.join(save_path or self.datp_dir, f'{self.fn_root}_vortz.npy'),
+                                  transform=lambda snap: AssignProps(snap, self.length_scale, self.grid()).vorticity_z,
+                                  shape=self.init_snap_array()[2:])
+        print('Vorticity field saved')
+        return snaps
 
     def vort_low_memory_saver(self, save_path=""):
-        for idx, fn in tqdm(enumerate(self.fns)):
-            snap = io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale)
-            snap = AssignProps(snap.reshape(1, *np.shape(snap)), self.length_scale).vorticity_z
+        axes = self.grid()
+        for idx, snap in tqdm(enumerate(self.next_snap()), total=len(self.fns)):
+            snap = AssignProps(snap, self.length_scale, axes).vorticity_z
             np.save(os.path.join(save_path, f'{self.fn_root}_vortz{idx}.npy'), snap)
             del snap
 
     def u_low_memory_saver(self, fn, count, save_path=""):
-        snap = io.read_vti(fn, self.length_scale)
-        snap = AssignProps(snap.reshape(1, *np.shape(snap)), self.length_scale).U
+        snap = io.read_vti(fn, self.length_scale, fields='u', window=self.window, stride=self.stride)
         np.save(os.path.join(save_path, f'{self.fn_root}_u{count}.npy'), snap)
         del snap
 
     def v_low_memory_saver(self, fn, count, save_path=""):
-        snap = io.read_vti(fn, self.length_scale)
-        snap = AssignProps(snap.reshape(1, *np.shape(snap)), self.length_scale).V
+        snap = io.read_vti(fn, self.length_scale, fields='v', window=self.window, stride=self.stride)
         np.save(os.path.join(save_path, f'{self.fn_root}_v{count}.npy'), snap)
         del snap
     
     def p_low_memory_saver(self, fn, count, save_path=""):
-        snap = io.read_vti(fn, self.length_scale)
-        snap = AssignProps(snap.reshape(1, *np.shape(snap)), self.length_scale).p
+        snap = io.read_vti(fn, self.length_scale, fields='p', window=self.window, stride=self.stride)
         np.save(os.path.join(save_path, f'{self.fn_root}_p{count}.npy'), snap)
         del snap
 
     def save_sdf(self, save_path=None):
         """
-        This function reads in the data from the paraview files saves as an binary, and
-        returns a numpy array of just the sdf field of the body.
-        :param save: If true, the data will be saved as a binary file.
-        :param part: If true, only the first snapshot will be saved.
-        :return: A numpy array of the data.
+        This function reads in the data from the paraview files, and streams just the
+        sdf field of the body into a binary one snapshot at a time.
+        :param save_path: Folder to save {fn_root}_p.npy in, the datp folder by default.
+        :return: The sdf/pressure field, memory mapped.
         """
-        try:
-            snaps = np.empty(self.init_snap_array())
-            for idx, fn in tqdm(enumerate(self.fns)):
-                snap = io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale)
-                snaps[idx] = np.array(snap)
-                del snap
-            snaps = AssignProps(snaps, self.length_scale).p
-            if save_path is not None:
-                np.save(os.path.join(save_path, f'{self.fn_root}_p.npy'), snaps)
-            else:
-                np.save(os.path.join(self.datp_dir, f'{self.fn_root}_p.npy'), snaps)
-            print('SDF/pressure field saved')
-            return snaps
-        except MemoryError:
-            print('Not enough memory to load all the data, at once saving individual time steps as binary and trying again')
-            try:
-                for idx, fn in tqdm(enumerate(self.fns)):
-                    snap = io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale)
-                    snap = AssignProps(snap, self.length_scale).p
-                    np.save(os.path.join(self.datp_dir, f'{self.fn_root}_p{idx}.npy'), snap)
-                    del snap
-                return snap
-            except MemoryError:
-                print('Not enough memory to load a single time step. Bigger machine?')
+        snaps = self.stream_snaps(os.path.join(save_path or self.datp_dir, f'{self.fn_root}_p.npy'),
+                                  fields='p', transform=lambda snap: snap[:, 0], shape=self.init_snap_array('p')[2:])
+        print('SDF/pressure field saved')
+        return snaps
 
     def save_sdf_low_memory(self, fn, count, save_path=""):
-        snap = io.read_vti(fn, self.length_scale)
-        snap = AssignProps(snap.reshape(1, *np.shape(snap)), self.length_scale).p
+        snap = io.read_vti(fn, self.length_scale, fields='p', window=self.window, stride=self.stride)
         np.save(os.path.join(save_path, f'{self.fn_root}_p{count}.npy'), snap)
         del snap
 
-    def init_snap_array(self):
+    def init_snap_array(self, fields='uvwp'):
         n_snaps = len(self.fns)
-        snapshot_shape = np.shape(io.read_vti(os.path.join(self.datp_dir, self.fns[0]), self.length_scale))
+        snapshot_shape = (len(io.check_fields(fields)),) + io.extent_shape(self.extent(), self.stride)
         return (n_snaps,) + snapshot_shape
 
     def init_flow(self, ext, fn_root, kwargs):
@@ -226,47 +508,58 @@ class ReadIn:
 
     def single_instance(self, ext):
         if ext == 'vti':
-            snap = io.read_vti(os.path.join(self.datp_dir, self.fns[-1]), self.length_scale)
+            snap = self.read_snap(self.fns[-1])
         else:
-            snap = io.read_vti(os.path.join(self.datp_dir, self.fns[-1]), self.length_scale)
+            snap = self.read_snap(self.fns[-1])
         # snap = np.array(snap).T
         return snap
 
-    # TODO: There's some array mismatch bug in time_avg
-    def time_avg(self, ext):
-        snaps = np.array([])
-        for idx, fn in enumerate(self.fns):
-            if ext == 'vti':
-                print(fn)
-                snap = io.read_vti(os.path.join(self.datp_dir, fn), self.length_scale)
-            else:
-                snap = io.vtr_format_2d(os.path.join(self.datp_dir, self.fns[-1]), self.length_scale)
-            snaps = np.append(snaps, snap)
-        del snap
-        # Time average the flow field snaps
-        print(np.shape(snaps))
-        t_mean = np.mean(snaps, axis=0)
-        return t_mean
+    def time_avg(self, ext=None):
+        """
+        The time mean of u, v, w and p, streamed a snapshot at a time.
+        """
+        return self.statistics().mean.astype(self.dtype)
+
+    def statistics(self, fields='uvwp', transform=None, names=None, workers=1):
+        """
+        Mean, RMS, Reynolds stresses, skewness and flatness of the whole run in one
+        streaming pass with constant memory, see statistics.StreamingStats.
+        :param fields: The variables to read.
+        :param transform: Applied to each (fields, ny, nx, nz) snapshot before it is added,
+                          e.g. to take the velocity magnitude.
+        :param names: Names of the variables transform returns, the fields by default.
+        :param workers: Split the run into this many segments accumulated on threads and merged at the end.
+        :return: The StreamingStats.
+        """
+        def accumulate(fns):
+            stats = StreamingStats(names or fields)
+            with snap_iterator.Prefetch(fns, partial(self.read_snap, fields=fields)) as reads:
+                for snap in tqdm(reads, total=len(fns), disable=workers > 1):
+                    stats.push(snap if transform is None else transform(snap))
+            return stats
+
+        segments = [self.fns[idx[0]:idx[-1] + 1] for idx in np.array_split(np.arange(len(self.fns)), workers) if len(idx)]
+        if workers == 1:
+            return accumulate(self.fns)
+        stats = StreamingStats(names or fields)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for part in pool.map(accumulate, segments):
+                stats.merge(part)
+        return stats
 
     def rms(self):
-        means = np.mean(np.array(self.snaps).T, axis=1)[2:-1]
-        fluctuations = np.array(self.snaps)[:, 2:-1] - means
-        del means
-        rms = np.mean((fluctuations[:, 0] ** 2 + fluctuations[:, 1] ** 2 + fluctuations[:, 2] ** 2) ** (1 / 2))
-        del fluctuations
-        return np.mean(rms, axis=2)
+        """
+        The RMS of the velocity fluctuations, sqrt(u'u' + v'v' + w'w'), averaged over the span.
+        """
+        return np.mean(np.sqrt(self.statistics('uvw').variance.sum(axis=0)), axis=2)
 
     def rms_mag(self):
-        mean = np.mean(np.array(self.snaps).T, axis=1)[2:-1]
-        mean = np.sqrt(np.sum(mean ** 2))
-        mag = np.array(self.snaps)[:, 2:-1] ** 2
-        mag = np.sum(mag, axis=1) ** 0.5
-        fluc = []
-        for snap in mag:
-            fluc.append(snap - mean)
-        del mag, mean
-
-        return np.mean(np.mean(fluc, axis=0), axis=2)
+        """
+        The RMS of the fluctuations of the velocity magnitude, averaged over the span.
+        """
+        stats = self.statistics('uvw', transform=lambda snap: evaluate('sqrt(u**2 + v**2 + w**2)', u=snap[0], v=snap[1],
+                                                                       w=snap[2])[None], names='m')
+        return np.mean(stats.rms[0], axis=2)
 
 # TODO: add in POD modes using Mauliks PyParSVD
 # TODO: add in phase average
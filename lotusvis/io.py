@@ -5,30 +5,503 @@
 @contact: jmom1n15@soton.ac.uk
 """
 import os
-import warnings
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import pyplot as plt
 
 import numpy as np
-import vtk
 
+VTK_DTYPES = {'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2', 'Int32': 'i4', 'UInt32': 'u4',
+              'Int64': 'i8', 'UInt64': 'u8', 'Float32': 'f4', 'Float64': 'f8'}
+# Lotus writes Float32, so snapshots stay in the precision they were written in for
+# storage and transport, and only reductions (averages, statistics) accumulate in float64.
+STORAGE_DTYPE = np.float32
+ACCUMULATOR_DTYPE = np.float64
+FIELDS = {'u': ('Velocity', 0), 'v': ('Velocity', 1), 'w': ('Velocity', 2), 'p': ('Pressure', 0)}
+_POOLS = {}
 
-def read_vti(file, length_scale):
-    warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
-    reader = vtk.vtkXMLPImageDataReader()
-    reader.SetFileName(file)
-    reader.Update()
-    data = reader.GetOutput()
-    point_data = data.GetPointData()
 
-    sh = data.GetDimensions()[::-1]
+def read_vti(file, length_scale, workers=None, fields='uvwp', window=None, stride=None, extent=None):
+    """
+    Read a Lotus snapshot straight from the raw appended data of its .vti pieces.
+    The pieces are memory mapped, so the only copy made is into the returned array
+    and only the DataArrays holding the requested fields are touched.
+    :param file: The .pvti (or a single .vti piece) to read.
+    :param length_scale: length scale of the simulation.
+    :param workers: Number of threads filling pieces concurrently, 1 reads them serially.
+    :param fields: The variables to read, any of 'u', 'v', 'w' and 'p', e.g. 'p' or ('u', 'v').
+    :param window: Only read the points inside ((xmin, xmax), (ymin, ymax)[, (zmin, zmax)]),
+                   given in units of length_scale. Pieces outside the window are not opened.
+    :param stride: Keep every (sx, sy, sz)th point (or every nth along each axis for an int),
+                   sampled straight from the memory maps, for quick looks at big runs.
+    :param extent: Read this index extent instead, e.g. the one a store was written with.
+    :return: Array of the fields in the order asked for, shape (len(fields), ny, nx, nz).
+    """
+    fields = check_fields(fields)
+    stride = check_stride(stride)
+    header, whole_extent, pieces, starts = snapshot_layout(file, length_scale, window, extent)
+    snap = np.empty((len(fields),) + extent_shape(whole_extent, stride), dtype=header['dtype'])
+    fill_pieces(snap, pieces, whole_extent, starts, fields, workers, stride)
+    return snap
 
-    velocity = np.array(point_data.GetVectors("Velocity")).reshape(sh + (len(sh),))
-    u, v, w = np.einsum('ijkl -> ljki', velocity)
 
-    p = np.array(point_data.GetScalars('Pressure')).reshape(sh)
-    p = np.einsum('ijk -> jki', p)
+def read_vtr(file, length_scale, workers=None, fields='uvwp', window=None, axes=None, stride=None, extent=None):
+    """
+    Read a Lotus snapshot on a stretched (rectilinear) grid from the raw appended data
+    of its .vtr pieces, the same way read_vti does.
+    :param file: The .pvtr (or a single .vtr piece) to read.
+    :param window: Only read the points inside ((xmin, xmax), (ymin, ymax)[, (zmin, zmax)]),
+                   given in units of length_scale.
+    :param axes: The (x, y, z) of the whole extent in simulation units, if already known from
+                 an earlier snapshot, see rectilinear_axes. The grid doesn't move between snapshots.
+    :param stride: Keep every (sx, sy, sz)th point, see read_vti.
+    :param extent: Read this index extent instead of the window's, see read_vti.
+    :return: (snap, (x, y, z)), the fields with shape (len(fields), ny, nx, nz) and
+             the 1D coordinates of the points in units of length_scale.
+    """
+    fields = check_fields(fields)
+    stride = check_stride(stride)
+    header, whole_extent, pieces, starts = snapshot_layout(file, length_scale, window, extent, axes)
+    snap = np.empty((len(fields),) + extent_shape(whole_extent, stride), dtype=header['dtype'])
+    fill_pieces(snap, pieces, whole_extent, starts, fields, workers, stride)
+    return snap, extent_axes(whole_extent, header, length_scale, stride)
 
-    return np.array((u, v, w, p))
+
+def read_span(file, length_scale, workers=None, fields='uvwp', window=None, rms=False, axes=None, stride=None):
+    """
+    Span average a 3D snapshot while reading it. Each piece is summed over z a plane at
+    a time straight from its memory map, so no 3D array is ever held.
+    :param file: The .pvti or .pvtr (or a single piece) to read.
+    :param window: Only average the points inside ((xmin, xmax), (ymin, ymax)[, (zmin, zmax)]).
+    :param rms: Also return the spanwise RMS of the fluctuations about the span mean.
+    :param axes: For a .pvtr, the (x, y, z) of the whole extent if already known, see read_vtr.
+    :param stride: Only sample every (sx, sy, sz)th point, see read_vti.
+    :return: The span mean of the fields with shape (len(fields), ny, nx), and with rms the span RMS.
+    """
+    fields = check_fields(fields)
+    stride = check_stride(stride)
+    header, whole_extent, pieces, starts = snapshot_layout(file, length_scale, window, axes=axes)
+    ny, nx, nz = extent_shape(whole_extent, stride)
+    total = np.zeros((len(fields), ny, nx), dtype=ACCUMULATOR_DTYPE)
+    squares = np.zeros_like(total) if rms else None
+
+    def sum_piece(piece):
+        return span_sum_piece(piece[1], piece[0], whole_extent, starts, fields, rms, stride)
+
+    sums = map(sum_piece, pieces) if workers == 1 or len(pieces) == 1 else piece_pool(workers).map(sum_piece, pieces)
+    for dst, piece_total, piece_squares in sums:
+        total[(slice(None),) + dst] += piece_total
+        if rms:
+            squares[(slice(None),) + dst] += piece_squares
+    mean = total / nz
+    if not rms:
+        return mean.astype(header['dtype'])
+    return mean.astype(header['dtype']), np.sqrt(np.maximum(squares / nz - mean ** 2, 0)).astype(header['dtype'])
+
+
+def snapshot_layout(file, length_scale, window=None, extent=None, axes=None):
+    """
+    Work out which part of a snapshot to read and from which pieces. A single .vti or
+    .vtr piece is read as a snapshot of one piece, so a window applies to it as well.
+    :param window: Crop to ((xmin, xmax), (ymin, ymax)[, (zmin, zmax)]) in units of length_scale.
+    :param extent: Read this index extent instead of the window's.
+    :param axes: The (x, y, z) of a rectilinear whole extent if already known, see rectilinear_axes.
+    :return: (header, the extent to read, the (extent, source) pieces overlapping it, piece starts).
+    """
+    if file.endswith(('.vti', '.vtr')):
+        piece = read_vti_header(file)
+        header = {'whole_extent': piece['extent'], 'origin': piece['origin'], 'spacing': piece['spacing'],
+                  'rectilinear': piece['coordinates'] is not None,
+                  'dtype': np.result_type(*[array['dtype'] for array in piece['arrays'].values()]),
+                  'pieces': [(piece['extent'], file)]}
+    else:
+        header = read_pvti_header(file)
+    if header['rectilinear']:
+        header['axes'] = rectilinear_axes(header) if axes is None else axes
+    pieces, starts = header['pieces'], piece_starts(header['pieces'])
+    if extent is None:
+        extent = header['whole_extent'] if window is None else window_extent(header, window, length_scale)
+    pieces = [(piece, source) for piece, source in pieces if overlaps(piece, extent)]
+    return header, tuple(extent), pieces, starts
+
+
+def span_sum_piece(source, extent, whole_extent, starts=None, fields='uvwp', rms=False, stride=None):
+    """
+    Sum one rank's piece over z (and its squares, with rms) in float64, a plane at a time.
+    :return: (the (y, x) slices of the global plane it covers, sums, squares or None).
+    """
+    piece = read_vti_header(source)
+    src, dst = piece_slices(extent, whole_extent, starts, stride)
+    shape = (len(fields), dst[0].stop - dst[0].start, dst[1].stop - dst[1].start)
+    total = np.zeros(shape, dtype=ACCUMULATOR_DTYPE)
+    squares = np.zeros(shape, dtype=ACCUMULATOR_DTYPE) if rms else None
+    arrays = {}
+    for idx, field in enumerate(fields):
+        name, component = FIELDS[field]
+        if name not in arrays:
+            arrays[name] = memmap_vti_array(source, name, piece)
+        for k in range(*src[2].indices(src[2].stop)):
+            plane = arrays[name][component, src[0], src[1], k]
+            total[idx] += plane
+            if rms:
+                squares[idx] += np.square(plane, dtype=ACCUMULATOR_DTYPE)
+    return dst[:2], total, squares
+
+
+def vtr_format_2d(fn, length_scale, rotation=0):
+    """
+    Rotates and scales a vtr file
+    :param fn: The .pvtr to read.
+    :param length_scale: length scale of the simulation
+    :param rotation: Rotate the grid by this many degrees. If you're running a simulation with
+                     an angle of attack, it's better to rotate the flow than the foil because of the meshing.
+    :return: X, Y - coordinates (useful for indexing), shape (ny, nx)
+             U, V - rotated velocity components
+             w    - un-rotated z velocity component
+             p    - pressure field, all shaped (ny, nx, nz)
+    """
+    rot = rotation / 180 * np.pi
+    (u, v, w, p), (x, y, _) = read_vtr(fn, length_scale)
+    x, y = np.meshgrid(x, y)
+    X = np.cos(rot) * x + np.sin(rot) * y
+    Y = -np.sin(rot) * x + np.cos(rot) * y
+    U = np.cos(rot) * u + np.sin(rot) * v
+    V = -np.sin(rot) * u + np.cos(rot) * v
+    return X, Y, U, V, w, p
+
+
+def fill_pieces(snap, pieces, whole_extent, starts=None, fields='uvwp', workers=None, stride=None):
+    """
+    Copy every piece into the global snapshot, concurrently unless workers is 1.
+    """
+    if workers == 1 or len(pieces) == 1:
+        for extent, source in pieces:
+            fill_piece(snap, source, extent, whole_extent, starts, fields, stride)
+    else:
+        jobs = [piece_pool(workers).submit(fill_piece, snap, source, extent, whole_extent, starts, fields, stride)
+                for extent, source in pieces]
+        for job in jobs:
+            job.result()
+
+
+def piece_pool(workers=None):
+    """
+    Thread pool shared by the piece reads (and the store's block codecs), so reading thousands of
+    snapshots doesn't respawn threads. The copies out of the memory maps release the GIL, so
+    the pieces are read concurrently.
+    """
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+    if workers not in _POOLS:
+        _POOLS[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='lotusvis-piece')
+    return _POOLS[workers]
+
+
+def fill_piece(snap, source, extent, whole_extent, starts=None, fields='uvwp', stride=None):
+    """
+    Copy one rank's piece into its place in the global snapshot. Points lying
+    outside the whole extent (the trailing plane Lotus writes) are dropped.
+    :param extent: Extent of the piece as listed in the .pvti.
+    :param starts: Piece start indices along each axis, see piece_starts. Planes
+                   shared with a neighbouring piece are left for that piece to write.
+    :param fields: The variables held along the first axis of snap.
+    :param stride: Only copy every (sx, sy, sz)th point of the whole extent.
+    """
+    piece = read_vti_header(source)
+    src, dst = piece_slices(extent, whole_extent, starts, stride)
+    arrays = {}
+    for idx, field in enumerate(fields):
+        name, component = FIELDS[field]
+        if name not in arrays:
+            arrays[name] = memmap_vti_array(source, name, piece)
+        snap[(idx,) + dst] = arrays[name][(component,) + src]
+
+
+def check_fields(fields):
+    """
+    Validate a field selector and return it as a tuple of variable names.
+    """
+    fields = tuple(fields)
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError(f"Unknown field '{field}', choose from {tuple(FIELDS)}")
+    return fields
+
+
+def check_stride(stride):
+    """
+    Validate a decimation factor and return it as (sx, sy, sz), or None for every point.
+    """
+    if stride is None:
+        return None
+    stride = (stride,) * 3 if np.isscalar(stride) else tuple(stride) + (1,) * (3 - len(stride))
+    if any(int(step) != step or step < 1 for step in stride):
+        raise ValueError(f'The stride {stride} should be positive integers')
+    stride = tuple(int(step) for step in stride)
+    return None if stride == (1, 1, 1) else stride
+
+
+def read_pvd(fn):
+    """
+    The output times Lotus lists in a .pvd collection, e.g. fluid.vti.pvd.
+    :return: dict of data file name (without its folder) to timestep, in file order.
+    """
+    root = ET.parse(fn).getroot()
+    return {os.path.basename(data.get('file')): float(data.get('timestep')) for data in root.iter('DataSet')}
+
+
+def natural_key(fn):
+    """
+    Sort key that orders the numbers in file names by value, so fluid.2 comes before fluid.10.
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', fn)]
+
+
+def read_pvti_header(fn):
+    """
+    Parse the .pvti (or .pvtr) that ties the rank pieces of a snapshot together.
+    :return: dict with the whole extent, origin, spacing, array dtype and a list of (extent, source) pieces.
+             A rectilinear grid has no origin or spacing, its coordinates are in the pieces.
+    """
+    root = ET.parse(fn).getroot()
+    grid = root.find(root.get('type'))
+    arrays = grid.find('PPointData').findall('PDataArray')
+    pieces = []
+    for piece in grid.findall('Piece'):
+        source = os.path.normpath(os.path.join(os.path.dirname(fn), piece.get('Source')))
+        pieces.append((_ints(piece.get('Extent')), source))
+    return {'whole_extent': _ints(grid.get('WholeExtent')),
+            'origin': _floats(grid.get('Origin')),
+            'spacing': _floats(grid.get('Spacing')),
+            'rectilinear': root.get('type') == 'PRectilinearGrid',
+            'dtype': np.result_type(*[VTK_DTYPES[a.get('type')] for a in arrays]),
+            'pieces': pieces}
+
+
+def snapshot_stat(fn):
+    """
+    Total size and latest modification time of a .pvti and its pieces, used to spot
+    snapshots that have been written or rewritten since they were cached.
+    """
+    paths = [fn] + [source for _, source in read_pvti_header(fn)['pieces']]
+    stats = [os.stat(path) for path in paths]
+    return sum(st.st_size for st in stats), max(st.st_mtime for st in stats)
+
+
+def snapshot_complete(fn):
+    """
+    Whether a .pvti and every piece it points at have been written out in full. Each
+    file ends in its closing </VTKFile> tag, so a missing, unparsable or unterminated
+    file means the solver is still writing the snapshot.
+    """
+    try:
+        paths = [fn] + [source for _, source in read_pvti_header(fn)['pieces']]
+    except (OSError, ET.ParseError):
+        return False
+    return all(_closed(path) for path in paths)
+
+
+def _closed(fn):
+    try:
+        with open(fn, 'rb') as f:
+            f.seek(max(0, os.path.getsize(fn) - 64))
+            return b'</VTKFile>' in f.read()
+    except OSError:
+        return False
+
+
+def read_vti_header(fn):
+    """
+    Parse the XML header of a .vti (or .vtr) piece written with raw appended data.
+    :return: dict with the piece extent, origin, spacing and the absolute
+             byte offset, dtype and number of components of each DataArray,
+             and of each coordinate array of a rectilinear grid.
+    """
+    with open(fn, 'rb') as f:
+        head = f.read(4096)
+        while b'<AppendedData' not in head:
+            chunk = f.read(4096)
+            if not chunk:
+                raise ValueError(f'{fn} has no appended data block')
+            head += chunk
+        tag = head.index(b'<AppendedData')
+        head += f.read(64)
+    data_start = head.index(b'_', tag) + 1
+    if b'encoding="raw"' not in head[tag:data_start]:
+        raise ValueError(f'{fn} is not raw encoded')
+
+    root = ET.fromstring(head[:tag] + b'</VTKFile>')
+    order = '<' if root.get('byte_order', 'LittleEndian') == 'LittleEndian' else '>'
+    size_dtype = np.dtype(order + VTK_DTYPES[root.get('header_type', 'UInt32')])
+
+    def spec(array):
+        return {'offset': data_start + int(array.get('offset')) + size_dtype.itemsize,
+                'dtype': np.dtype(order + VTK_DTYPES[array.get('type')]),
+                'components': int(array.get('NumberOfComponents', 1))}
+
+    grid = root.find(root.get('type'))
+    piece = grid.find('Piece')
+    coordinates = piece.find('Coordinates')
+    return {'extent': _ints(piece.get('Extent')),
+            'origin': _floats(grid.get('Origin')),
+            'spacing': _floats(grid.get('Spacing')),
+            'arrays': {array.get('Name'): spec(array) for array in piece.find('PointData').iter('DataArray')},
+            'coordinates': None if coordinates is None else [spec(array) for array in coordinates.iter('DataArray')]}
+
+
+def memmap_vti_array(fn, name, header=None):
+    """
+    Memory map a DataArray of a .vti piece without reading it.
+    :param fn: The .vti piece.
+    :param name: Name of the DataArray, e.g. 'Velocity' or 'Pressure'.
+    :param header: The parsed header of fn, if already known.
+    :return: Read-only view with shape (components, ny, nx, nz).
+    """
+    if header is None:
+        header = read_vti_header(fn)
+    array = header['arrays'][name]
+    ny, nx, nz = extent_shape(header['extent'])
+    data = np.memmap(fn, dtype=array['dtype'], mode='r', offset=array['offset'],
+                     shape=(nz, ny, nx, array['components']))
+    return data.transpose(3, 1, 2, 0)
+
+
+def piece_axes(fn, header=None):
+    """
+    The x, y and z coordinates stored in a .vtr piece, memory mapped.
+    """
+    if header is None:
+        header = read_vti_header(fn)
+    ny, nx, nz = extent_shape(header['extent'])
+    return tuple(np.memmap(fn, dtype=array['dtype'], mode='r', offset=array['offset'], shape=(n,))
+                 for array, n in zip(header['coordinates'], (nx, ny, nz)))
+
+
+def rectilinear_axes(header):
+    """
+    Stitch the coordinates of the pieces of a .pvtr into the 1D axes of the whole extent.
+    :param header: Parsed .pvtr header, see read_pvti_header.
+    :return: (x, y, z) in simulation units.
+    """
+    whole_extent = header['whole_extent']
+    axes = [np.empty(whole_extent[2 * axis + 1] - whole_extent[2 * axis] + 1) for axis in range(3)]
+    for extent, source in header['pieces']:
+        for axis, coords in enumerate(piece_axes(source)):
+            lo = max(extent[2 * axis], whole_extent[2 * axis])
+            hi = min(extent[2 * axis + 1], whole_extent[2 * axis + 1])
+            axes[axis][lo - whole_extent[2 * axis]:hi - whole_extent[2 * axis] + 1] = \
+                coords[lo - extent[2 * axis]:hi - extent[2 * axis] + 1]
+    return tuple(axes)
+
+
+def window_extent(header, window, length_scale):
+    """
+    The part of the whole extent covering a physical window. The window is widened
+    to the enclosing grid points so nothing inside it is cut off.
+    :param header: Parsed .pvti header, see read_pvti_header. A rectilinear grid needs
+                   its 'axes' as well, see rectilinear_axes.
+    :param window: ((xmin, xmax), (ymin, ymax)[, (zmin, zmax)]) in units of length_scale,
+                   an axis given as None is not cropped.
+    :return: The cropped extent.
+    """
+    extent = list(header['whole_extent'])
+    for axis, lims in enumerate(window):
+        if lims is None:
+            continue
+        lo, hi = sorted(lims)
+        if header.get('axes') is not None:
+            coords, start = header['axes'][axis], header['whole_extent'][2 * axis]
+            first = start + np.searchsorted(coords, lo * length_scale, side='right') - 1
+            last = start + np.searchsorted(coords, hi * length_scale, side='left')
+        else:
+            origin, spacing = header['origin'][axis], header['spacing'][axis]
+            first = int(np.floor((lo * length_scale - origin) / spacing))
+            last = int(np.ceil((hi * length_scale - origin) / spacing))
+        extent[2 * axis] = max(extent[2 * axis], int(first))
+        extent[2 * axis + 1] = min(extent[2 * axis + 1], int(last))
+        if extent[2 * axis] > extent[2 * axis + 1]:
+            raise ValueError(f'The window {window} lies outside the domain')
+    return tuple(extent)
+
+
+def overlaps(extent, other):
+    """
+    Whether two extents share any points.
+    """
+    return all(extent[2 * axis] <= other[2 * axis + 1] and other[2 * axis] <= extent[2 * axis + 1]
+               for axis in range(3))
+
+
+def extent_axes(extent, header, length_scale, stride=None):
+    """
+    The 1D x, y and z coordinates of the points in an extent, in units of length_scale.
+    :param header: Parsed .pvti header, or a .pvtr header with its 'axes'.
+    :param stride: Only the coordinates of every (sx, sy, sz)th point, the spacing grows to match.
+    """
+    stride = check_stride(stride) or (1, 1, 1)
+    if header.get('axes') is not None:
+        whole_extent = header['whole_extent']
+        return tuple(header['axes'][axis][extent[2 * axis] - whole_extent[2 * axis]:
+                                          extent[2 * axis + 1] - whole_extent[2 * axis] + 1:stride[axis]] / length_scale
+                     for axis in range(3))
+    origin, spacing = header['origin'], header['spacing']
+    return tuple((origin[axis] + spacing[axis] * np.arange(extent[2 * axis], extent[2 * axis + 1] + 1, stride[axis]))
+                 / length_scale for axis in range(3))
+
+
+def extent_shape(extent, stride=None):
+    """
+    Number of points in a VTK extent in the (ny, nx, nz) order used by the snapshots.
+    :param stride: Count only every (sx, sy, sz)th point.
+    """
+    x0, x1, y0, y1, z0, z1 = extent
+    sx, sy, sz = stride or (1, 1, 1)
+    return (y1 - y0) // sy + 1, (x1 - x0) // sx + 1, (z1 - z0) // sz + 1
+
+
+def piece_starts(pieces):
+    """
+    The indices at which pieces start along x, y and z.
+    """
+    return tuple({extent[2 * axis] for extent, _ in pieces} for axis in range(3))
+
+
+def piece_slices(extent, whole_extent, starts=None, stride=None):
+    """
+    Slices that map the part of a piece inside the whole extent onto the global array.
+    Neighbouring Lotus pieces share their boundary plane; given the piece starts, the
+    upper plane is handed to the piece that starts on it so each point is written once.
+    :param stride: Only map every (sx, sy, sz)th point of the whole extent, onto the
+                   correspondingly smaller global array.
+    :return: (piece slices, global slices), both ordered (y, x, z).
+    """
+    src, dst = [], []
+    for axis in (1, 0, 2):
+        lo = max(extent[2 * axis], whole_extent[2 * axis])
+        hi = min(extent[2 * axis + 1], whole_extent[2 * axis + 1])
+        if starts is not None and hi in starts[axis] and hi > lo:
+            hi -= 1
+        step = stride[axis] if stride else 1
+        # First point on the strided lattice of the whole extent
+        first = -(-(lo - whole_extent[2 * axis]) // step) * step + whole_extent[2 * axis]
+        if first > hi:
+            src.append(slice(0, 0))
+            dst.append(slice(0, 0))
+            continue
+        src.append(slice(first - extent[2 * axis], hi - extent[2 * axis] + 1, step if stride else None))
+        dst.append(slice((first - whole_extent[2 * axis]) // step, (hi - whole_extent[2 * axis]) // step + 1))
+    return tuple(src), tuple(dst)
+
+
+def _ints(attr):
+    return tuple(int(v) for v in attr.split())
+
+
+def _floats(attr):
+    if attr is None:
+        return None
+    return tuple(float(v) for v in attr.split())
 
 
 def generate_grid(sh, bounds, length_scale):
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Jonathan Massey
+@description: Read the text logs Lotus appends to while it runs (fort.9, fort.8 and mpi.csv)
+@contact: masseyjmo@gmail.com
+"""
+import os
+from io import BytesIO
+
+import numpy as np
+from numpy.lib import recfunctions
+
+# fort.9 is t, dt and then the force and power coefficients, however many the run writes
+FORT9_NAMES = ('t', 'dt')
+FORT8_NAMES = ('iterations', 'res0', 'res', 'inf')
+
+
+class Log:
+    """
+    A text log parsed into a structured array. The parsed rows are cached next to the log
+    with the byte offset they were read up to, so a refresh only parses what the solver
+    has appended since, and a half written last line is left for the next refresh.
+    """
+
+    def __init__(self, path, names=None, delimiter=None, header=False, formats=None, cache=True):
+        """
+        :param path: The log file.
+        :param names: Column names, the columns past these are called c0, c1, ...
+        :param delimiter: Column separator, any whitespace if None.
+        :param header: The first line holds the column names.
+        :param formats: dict of column name to dtype, float64 otherwise.
+        :param cache: Keep the parsed rows in {path}.npz between sessions.
+        """
+        self.path = path
+        self.names = tuple(names or ())
+        self.delimiter = delimiter
+        self.header = header
+        self.formats = formats or {}
+        self.cache_path = f'{path}.npz' if cache else None
+        self._data, self.offset, self.head = None, 0, b''
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            with np.load(self.cache_path) as cached:
+                if len(cached['data']):
+                    self._data, self.offset, self.head = cached['data'], int(cached['offset']), cached['head'].tobytes()
+        self.refresh()
+
+    @property
+    def data(self):
+        """
+        The rows parsed so far, an empty structured array until the solver writes the first.
+        """
+        return np.empty(0, dtype=self.dtype(len(self.names))) if self._data is None else self._data
+
+    def refresh(self):
+        """
+        Parse the lines appended since the last read, starting over if the log was rewritten.
+        Nothing is kept, or cached, until there is a whole row of data after any header.
+        :return: The new rows.
+        """
+        with open(self.path, 'rb') as f:
+            head = f.read(256)
+            size = os.fstat(f.fileno()).st_size
+            if self._data is None or size < self.offset or not (head.startswith(self.head) or self.head.startswith(head)):
+                self._data, self.offset = None, 0
+            if size == self.offset and self._data is not None:
+                return self._data[:0]
+            f.seek(self.offset)
+            chunk = f.read()
+        chunk = chunk[:chunk.rfind(b'\n') + 1]
+        offset = self.offset
+        if self._data is None and self.header and chunk:
+            names, chunk = chunk.split(b'\n', 1)
+            self.names = tuple(name.strip() for name in names.decode().split(self.delimiter or None))
+            offset += len(names) + 1
+        if not chunk.strip():
+            return self.data[:0]
+        rows = self.parse(chunk)
+        self.offset = offset + len(chunk)
+        self.head = head
+        self._data = rows if self._data is None else np.concatenate((self._data, rows))
+        if self.cache_path is not None:
+            np.savez(self.cache_path, data=self._data, offset=self.offset, head=np.frombuffer(head, dtype=np.uint8))
+        return rows
+
+    def parse(self, chunk):
+        """
+        Parse complete lines into structured rows with numpy's C reader, which also
+        checks every line has the same number of columns.
+        """
+        values = np.loadtxt(BytesIO(chunk), dtype=np.float64, delimiter=self.delimiter, ndmin=2)
+        if self._data is not None and values.shape[1] != len(self._data.dtype.names):
+            raise ValueError(f'{self.path} has lines with other than {len(self._data.dtype.names)} columns')
+        return recfunctions.unstructured_to_structured(values, self.dtype(values.shape[1]))
+
+    def dtype(self, columns):
+        if self._data is not None:
+            return self._data.dtype
+        names = list(self.names[:columns]) + [f'c{idx}' for idx in range(columns - len(self.names))]
+        return np.dtype([(name, self.formats.get(name, np.float64)) for name in names])
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, item):
+        return self.data[item]
+
+
+def force_history(sim_dir, **kwargs):
+    """
+    The force/time history Lotus writes to fort.9.
+    """
+    return Log(os.path.join(sim_dir, 'fort.9'), FORT9_NAMES, **kwargs)
+
+
+def solver_log(sim_dir, **kwargs):
+    """
+    The pressure solver's iterations and residuals from fort.8.
+    """
+    return Log(os.path.join(sim_dir, 'fort.8'), FORT8_NAMES, formats={'iterations': np.int64}, **kwargs)
+
+
+def mpi_timings(sim_dir, **kwargs):
+    """
+    The per-step MPI timings from mpi.csv, named by its header.
+    """
+    return Log(os.path.join(sim_dir, 'mpi.csv'), delimiter=',', header=True, **kwargs)
+
+
+def align(data, times, time='t', time_scale=1.):
+    """
+    Interpolate every column of a log onto the snapshot times.
+    :param data: Structured rows with a time column, e.g. force_history(sim_dir).data.
+    :param times: The snapshot times, e.g. ReadIn.times from the .pvd.
+    :param time_scale: Multiply the log's time column by this to get the .pvd times.
+    :return: Structured array with one row per snapshot, NaN outside the logged times.
+    """
+    logged = data[time] * time_scale
+    out = np.empty(len(times), dtype=[(name, np.float64) for name in data.dtype.names])
+    for name in data.dtype.names:
+        out[name] = np.interp(times, logged, data[name], left=np.nan, right=np.nan)
+    return out
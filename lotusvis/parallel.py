@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Jonathan Massey
+@description: Fan derived-field work out over snapshots to worker processes through shared memory
+@contact: masseyjmo@gmail.com
+"""
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+from tqdm import tqdm
+
+from lotusvis.assign_props import AssignProps
+
+
+class SharedArray:
+    """
+    A NumPy array in a named shared memory block. Only its (name, shape, dtype) spec
+    is pickled to a worker, which maps the same memory rather than receiving a copy.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size if name is None else 0)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+
+    @property
+    def spec(self):
+        return self.shm.name, self.array.shape, self.array.dtype.str
+
+    @classmethod
+    def attach(cls, spec):
+        name, shape, dtype = spec
+        return cls(shape, dtype, name)
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
+
+
+def derive_snap(spec, idx, quantity, length_scale, axes, out_path):
+    """
+    Worker side: work out a quantity of the snapshot in shared memory and write it into
+    the result .npy in place.
+    :return: idx, once the result is written.
+    """
+    shared = SharedArray.attach(spec)
+    try:
+        _write(shared.array, idx, quantity, length_scale, axes, out_path)
+    finally:
+        shared.close()
+    return idx
+
+
+def _write(snap, idx, quantity, length_scale, axes, out_path):
+    props = AssignProps(snap[None], length_scale, axes)
+    out = np.load(out_path, mmap_mode='r+')
+    out[idx] = quantity(props)[0] if callable(quantity) else getattr(props, quantity)[0]
+    out.flush()
+
+
+def shared_memory_free():
+    """
+    Bytes free in /dev/shm, where the shared memory blocks live on Linux, or 2 GB where there isn't one.
+    """
+    try:
+        stat = os.statvfs('/dev/shm')
+    except (AttributeError, OSError):
+        return 2 ** 31
+    return stat.f_bavail * stat.f_frsize
+
+
+def derived_fields(sim, quantity, out_path, workers=None, fields='uvwp', slots=None, nbytes=None):
+    """
+    Work out an AssignProps quantity for every snapshot of a run on a pool of processes.
+    Snapshots are read ahead on threads into a ring of shared memory slots, each worker
+    maps its slot and writes its result into the shared .npy, so no array is pickled.
+    :param sim: The ReadIn to read from.
+    :param quantity: Name of an AssignProps property, e.g. 'vorticity_z', or a picklable
+                     (module level) function of an AssignProps.
+    :param out_path: The .npy of shape (nt, ny, nx, nz) to write the results to.
+    :param workers: Number of processes, all the cores by default.
+    :param slots: Snapshots held in shared memory at once. By default one per worker and two
+                  being read ahead, as many of those as fit in nbytes and never fewer than one.
+                  The shared memory (/dev/shm on Linux) used is slots times one snapshot of the
+                  fields, e.g. a 4 field 1024x512x256 float32 snapshot is 2.1 GB, so 66 slots
+                  for 64 workers would need 142 GB.
+    :param nbytes: Shared memory budget for the default number of slots, half of what is free
+                   in /dev/shm if there is one, 1 GB otherwise.
+    :return: The results, memory mapped.
+    The workers are started fresh rather than forked, so a script calling this needs the
+    usual if __name__ == '__main__': guard.
+    """
+    workers = workers or os.cpu_count() or 1
+    # Forking now would copy the prefetch and piece pools without their threads, so start clean workers
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+    shape = sim.init_snap_array(fields)[1:]
+    axes = sim.grid()
+    np.lib.format.open_memmap(out_path, mode='w+', dtype=sim.dtype, shape=(len(sim.fns),) + shape[1:]).flush()
+
+    if slots is None:
+        snap_bytes = int(np.prod(shape)) * np.dtype(sim.dtype).itemsize
+        slots = max(1, min(workers + 2, (nbytes or shared_memory_free() // 2) // snap_bytes))
+    free = deque(SharedArray(shape, sim.dtype) for _ in range(slots))
+    ring = list(free)
+    pending = {}
+    try:
+        with pool, tqdm(total=len(sim.fns)) as progress:
+            for idx, snap in enumerate(sim.next_snap(fields)):
+                while not free:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for job in done:
+                        job.result()
+                        free.append(pending.pop(job))
+                        progress.update()
+                slot = free.popleft()
+                slot.array[...] = snap[0]
+                pending[pool.submit(derive_snap, slot.spec, idx, quantity, sim.length_scale, axes, out_path)] = slot
+            for job in list(pending):
+                job.result()
+                pending.pop(job)
+                progress.update()
+    finally:
+        for job in pending:
+            job.cancel()
+        pool.shutdown(wait=True)
+        for slot in ring:
+            slot.unlink()
+    return np.load(out_path, mmap_mode='r')
@@ -13,6 +13,7 @@ import seaborn as sns
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 from lotusvis.flow_field import ReadIn
+from lotusvis.kernels import evaluate
 
 
 def _rec(theta):
@@ -22,10 +23,10 @@ def _rec(theta):
 
 
 class Plots(ReadIn):
-    def __init__(self, sim_dir, fn_root, length_scale, cmap=None):
-        super().__init__(sim_dir, fn_root, length_scale, span_avg=True)
+    def __init__(self, sim_dir, fn_root, length_scale, cmap=None, **kwargs):
+        super().__init__(sim_dir, fn_root, length_scale, span_avg=True, **kwargs)
         self.cmap = cmap
-        self.mag = np.sqrt(self.V ** 2 + self.U ** 2)
+        self.mag = evaluate('sqrt(u**2 + v**2)', u=self.U, v=self.V)
 
     @property
     def vort(self):
@@ -4,4 +4,258 @@
 @description: This class will help with saving data into a form better suited for quick io
 @contact: masseyjmo@gmail.com
 """
+import h5py
+import numpy as np
 
+import lotusvis.io as io
+
+try:
+    import zstandard
+except ImportError:  # Only needed for the CompressedStore
+    zstandard = None
+
+
+class SnapStore:
+    """
+    HDF5 store of snapshots with shape (nt, fields, ny, nx, nz), chunked along time and
+    space so any (time, variable, region) slab can be read without loading the rest.
+    Snapshots are appended one at a time, so the store never has to fit in memory.
+    Alongside each snapshot the store keeps a manifest entry of the size and mtime
+    of its source files, so a running simulation can be refreshed incrementally.
+    """
+    data_name = 'snaps'
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.file = h5py.File(path, mode)
+        self.data = self.file[self.data_name]
+        self.index = {fn: idx for idx, fn in enumerate(self.fns)}
+
+    @classmethod
+    def create(cls, path, snap_shape, fields='uvwp', dtype=io.STORAGE_DTYPE, chunks=None, **attrs):
+        """
+        Start an empty store.
+        :param snap_shape: The (ny, nx, nz) shape of a snapshot.
+        :param chunks: HDF5 chunk shape, by default a few snapshots by roughly 1MB of space.
+        :param attrs: Extra metadata, e.g. whole_extent, origin, spacing and length_scale.
+        """
+        fields = io.check_fields(fields)
+        shape = (len(fields),) + tuple(snap_shape)
+        with h5py.File(path, 'w') as f:
+            f.attrs['shape'] = shape
+            f.attrs['dtype'] = np.dtype(dtype).str
+            for key, value in attrs.items():
+                f.attrs[key] = value
+            cls.create_data(f, shape, np.dtype(dtype), chunks)
+            f.create_dataset('fns', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+            f.create_dataset('sizes', shape=(0,), maxshape=(None,), dtype=np.int64)
+            f.create_dataset('mtimes', shape=(0,), maxshape=(None,), dtype=np.float64)
+            f.attrs['fields'] = ''.join(fields)
+        return cls(path, 'r+')
+
+    @staticmethod
+    def create_data(f, shape, dtype, chunks):
+        f.create_dataset('snaps', shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                         chunks=chunks or default_chunks(shape, dtype.itemsize))
+
+    @property
+    def fields(self):
+        return tuple(self.file.attrs['fields'])
+
+    @property
+    def fns(self):
+        return [fn.decode() if isinstance(fn, bytes) else fn for fn in self.file['fns'][:]]
+
+    @property
+    def manifest(self):
+        """
+        The (size, mtime) of the source files of each stored snapshot, keyed by file name.
+        """
+        return dict(zip(self.fns, zip(self.file['sizes'][:].tolist(), self.file['mtimes'][:].tolist())))
+
+    @property
+    def attrs(self):
+        return self.file.attrs
+
+    @property
+    def shape(self):
+        """
+        The (fields, ny, nx, nz) shape of a stored snapshot.
+        """
+        return tuple(int(n) for n in self.attrs['shape'])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.attrs['dtype'])
+
+    def __len__(self):
+        return self.file['fns'].shape[0]
+
+    def append(self, snap, fn='', stat=(-1, -1.)):
+        """
+        Write the next snapshot to the end of the store.
+        :param stat: (size, mtime) of the source files, see io.snapshot_stat.
+        """
+        idx = len(self)
+        for name in (self.data_name, 'fns', 'sizes', 'mtimes'):
+            self.file[name].resize(idx + 1, axis=0)
+        self.file['fns'][idx] = fn
+        self.index[fn] = idx
+        self.write(idx, snap, stat)
+
+    def write(self, idx, snap, stat=(-1, -1.)):
+        """
+        Overwrite a stored snapshot, e.g. one Lotus has since rewritten.
+        """
+        self.write_snap(idx, snap)
+        self.file['sizes'][idx], self.file['mtimes'][idx] = stat
+
+    def write_snap(self, idx, snap):
+        self.data[idx] = snap
+
+    def region(self, extent=None, window=None, stride=None):
+        """
+        Index slices of the part of the stored domain covering an extent or a physical window.
+        :param extent: Index extent in the same space as the .pvti WholeExtent.
+        :param window: ((xmin, xmax), (ymin, ymax)[, (zmin, zmax)]) in units of the stored length_scale.
+        :param stride: Only every (sx, sy, sz)th point of the extent, see io.read_vti.
+        :return: (y, x, z) slices.
+        """
+        stored = tuple(self.attrs['whole_extent'])
+        if window is not None:
+            if 'origin' in self.attrs:
+                header = {'whole_extent': stored, 'origin': self.attrs['origin'], 'spacing': self.attrs['spacing']}
+            else:
+                header = {'whole_extent': stored, 'axes': tuple(self.attrs[axis] for axis in 'xyz')}
+            extent = io.window_extent(header, window, self.attrs['length_scale'])
+        if extent is None:
+            extent = stored
+        if not all(stored[2 * axis] <= extent[2 * axis] and extent[2 * axis + 1] <= stored[2 * axis + 1]
+                   for axis in range(3)):
+            raise ValueError(f'The extent {extent} is not inside the stored {stored}')
+        return io.piece_slices(stored, extent, stride=io.check_stride(stride))[0]
+
+    def read(self, t=slice(None), fields=None, region=None):
+        """
+        Read a slab of the store.
+        :param t: Time index, slice or increasing list of indices.
+        :param fields: The variables to read, by default all the stored ones.
+        :param region: (y, x, z) slices, see region.
+        :return: Array of shape (nt, len(fields), ny, nx, nz), without the time axis if t is an int.
+        """
+        fields = io.check_fields(fields or self.fields)
+        region = region or (slice(None),) * 3
+        slabs = [self.data[(t, self.fields.index(field)) + tuple(region)] for field in fields]
+        return np.stack(slabs, axis=0 if np.isscalar(t) else 1)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CompressedStore(SnapStore):
+    """
+    SnapStore whose snapshots are split into blocks of rows and compressed with zstandard,
+    optionally after byte-shuffling (which groups the bytes of the floats by significance)
+    and error-bounded quantisation for quick-look copies. Blocks are compressed and
+    decompressed in parallel and reads give back the same arrays as a SnapStore.
+    """
+    data_name = 'blocks'
+
+    def __init__(self, path, mode='r'):
+        if zstandard is None:
+            raise ImportError('The CompressedStore needs zstandard, pip install zstandard')
+        super().__init__(path, mode)
+        self.rows = int(self.attrs['rows'])
+        self.level = int(self.attrs['level'])
+        self.shuffle = bool(self.attrs['shuffle'])
+        self.tolerance = float(self.attrs['tolerance'])
+
+    @classmethod
+    def create(cls, path, snap_shape, fields='uvwp', dtype=io.STORAGE_DTYPE, chunks=None,
+               level=3, shuffle=True, tolerance=0., **attrs):
+        """
+        Start an empty compressed store.
+        :param chunks: Rows (along y) per compressed block, by default roughly 1MB of raw data.
+        :param level: zstandard compression level.
+        :param shuffle: Byte-shuffle the values before compressing.
+        :param tolerance: If positive, quantise the values to within this absolute error
+                          (plus the rounding back to the stored precision).
+        """
+        return super().create(path, snap_shape, fields, dtype, chunks, codec='zstd',
+                              level=level, shuffle=shuffle, tolerance=tolerance, **attrs)
+
+    @staticmethod
+    def create_data(f, shape, dtype, chunks):
+        row_bytes = int(np.prod(shape[2:])) * dtype.itemsize
+        rows = chunks or int(np.clip(2 ** 20 // row_bytes, 1, shape[1]))
+        f.attrs['rows'] = rows
+        n_blocks = -(-shape[1] // rows)
+        f.create_dataset('blocks', shape=(0, shape[0], n_blocks), maxshape=(None, shape[0], n_blocks),
+                         dtype=h5py.vlen_dtype(np.uint8))
+
+    def encode(self, block):
+        if self.tolerance > 0:
+            block = np.round(np.divide(block, 2 * self.tolerance, dtype=io.ACCUMULATOR_DTYPE))
+            if np.abs(block).max(initial=0) >= 2 ** 31:
+                raise ValueError(f'Values are too large to quantise to a tolerance of {self.tolerance}')
+            block = block.astype(np.int32)
+        raw = np.ascontiguousarray(block).view(np.uint8)
+        if self.shuffle:
+            raw = np.ascontiguousarray(raw.reshape(-1, block.itemsize).T)
+        return np.frombuffer(zstandard.ZstdCompressor(level=self.level).compress(raw.tobytes()), dtype=np.uint8)
+
+    def decode(self, blob):
+        dtype = np.dtype(np.int32) if self.tolerance > 0 else self.dtype
+        raw = np.frombuffer(zstandard.ZstdDecompressor().decompress(blob.tobytes()), dtype=np.uint8)
+        if self.shuffle:
+            raw = np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T)
+        block = raw.view(dtype)
+        if self.tolerance > 0:
+            block = (block * (2 * self.tolerance)).astype(self.dtype)
+        return block.reshape((-1,) + self.shape[2:])
+
+    def write_snap(self, idx, snap):
+        pool = io.piece_pool()
+        for k, field in enumerate(snap):
+            blocks = [field[b:b + self.rows] for b in range(0, field.shape[0], self.rows)]
+            for b, blob in enumerate(pool.map(self.encode, blocks)):
+                self.data[idx, k, b] = blob
+
+    def read(self, t=slice(None), fields=None, region=None):
+        fields = io.check_fields(fields or self.fields)
+        ys, xs, zs = region or (slice(None),) * 3
+        y0, y1, y_step = ys.indices(self.shape[1])
+        b0, b1 = y0 // self.rows, -(-y1 // self.rows)
+        times = np.arange(len(self))[t]
+        slabs = [self.data[idx, self.fields.index(field), b0:b1] for idx in np.atleast_1d(times) for field in fields]
+        blocks = list(io.piece_pool().map(self.decode, [blob for slab in slabs for blob in slab]))
+        snaps = np.stack([np.concatenate(blocks[i:i + b1 - b0]) for i in range(0, len(blocks), b1 - b0)])
+        snaps = snaps.reshape((np.size(times), len(fields)) + snaps.shape[1:])
+        snaps = snaps[:, :, y0 - b0 * self.rows:y1 - b0 * self.rows:y_step, xs, zs]
+        return snaps[0] if np.ndim(times) == 0 else snaps
+
+
+def open_store(path, mode='r'):
+    """
+    Open a SnapStore or CompressedStore, whichever the file holds.
+    """
+    with h5py.File(path, 'r') as f:
+        compressed = f.attrs.get('codec', '') == 'zstd'
+    return CompressedStore(path, mode) if compressed else SnapStore(path, mode)
+
+
+def default_chunks(shape, itemsize, nbytes=2 ** 20, nt=4):
+    """
+    Chunk of nt snapshots of one field, halving the largest spatial dimension until it fits in nbytes.
+    """
+    space = list(shape[1:])
+    while np.prod(space) * itemsize * nt > nbytes and max(space) > 1:
+        axis = int(np.argmax(space))
+        space[axis] = (space[axis] + 1) // 2
+    return (nt, 1) + tuple(space)
@@ -1,4 +1,5 @@
-
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 class Fn:
@@ -20,4 +21,57 @@ class Fn:
             return fn
         else:
             raise StopIteration
-            
+
+
+class Prefetch:
+
+    """
+    Iterator that reads the snaps after the current one on worker threads, so the
+    disk keeps busy while the consumer computes. Snaps come back in order and at
+    most `depth` of them are held ahead of the consumer.
+    """
+
+    def __init__(self, fns: list, read, depth=2, workers=None, start=0):
+        self.fns = Fn(fns, start)
+        self.read = read
+        self.depth = max(1, depth)
+        self.pool = ThreadPoolExecutor(max_workers=workers or self.depth, thread_name_prefix='lotusvis-prefetch')
+        self.queue = deque()
+        self.fill()
+
+    def fill(self):
+        while len(self.queue) < self.depth:
+            fn = next(self.fns, None)
+            if fn is None:
+                break
+            self.queue.append(self.pool.submit(self.read, fn))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.queue:
+            self.close()
+            raise StopIteration
+        try:
+            snap = self.queue.popleft().result()
+        except BaseException:
+            self.close()
+            raise
+        self.fill()
+        return snap
+
+    def close(self):
+        """
+        Drop the snaps not yet started and wait for the ones being read.
+        """
+        for job in self.queue:
+            job.cancel()
+        self.queue.clear()
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Jonathan Massey
+@description: Single pass flow statistics that can be merged across workers and run segments
+@contact: masseyjmo@gmail.com
+"""
+import numpy as np
+
+import lotusvis.io as io
+
+
+class StreamingStats:
+    """
+    Running mean, (co)variances and third and fourth central moments of snapshots, kept
+    in float64 and updated a snapshot (or a batch of them) at a time with Welford's
+    update. Two accumulators merge exactly with Chan et al.'s pairwise formulas, so a
+    run can be split between workers or segments and combined at the end.
+    """
+
+    def __init__(self, fields='uvwp'):
+        """
+        :param fields: Names of the variables along the first axis of each snapshot.
+        """
+        self.fields = tuple(fields)
+        self.n = 0
+        self.mean, self.m2, self.m3, self.m4 = None, None, None, None
+        # Co-moments sum (x_i - mean_i)(x_j - mean_j) for every pair i < j, the diagonal is m2
+        self.cross = {}
+
+    def push(self, snaps):
+        """
+        Add a snapshot of shape (fields, ny, nx, nz), or a batch (n, fields, ny, nx, nz).
+        """
+        snaps = np.asarray(snaps)
+        if snaps.ndim == 4:
+            snaps = snaps[None]
+        batch = StreamingStats(self.fields)
+        batch.n = len(snaps)
+        batch.mean = snaps.mean(axis=0, dtype=io.ACCUMULATOR_DTYPE)
+        deviation = snaps - batch.mean
+        batch.m2 = np.einsum('n...,n...->...', deviation, deviation)
+        batch.m3 = np.einsum('n...,n...,n...->...', deviation, deviation, deviation)
+        batch.m4 = np.einsum('n...,n...->...', deviation ** 2, deviation ** 2)
+        batch.cross = {(i, j): np.einsum('n...,n...->...', deviation[:, i], deviation[:, j])
+                       for i in range(len(self.fields)) for j in range(i + 1, len(self.fields))}
+        return self.merge(batch)
+
+    def merge(self, other):
+        """
+        Fold another accumulator into this one, as though its snapshots had been pushed here.
+        :return: self.
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2, self.m3, self.m4 = other.n, other.mean.copy(), other.m2.copy(), \
+                other.m3.copy(), other.m4.copy()
+            self.cross = {key: value.copy() for key, value in other.cross.items()}
+            return self
+        na, nb = self.n, other.n
+        n = na + nb
+        delta = other.mean - self.mean
+        self.m4 += other.m4 + delta ** 4 * na * nb * (na ** 2 - na * nb + nb ** 2) / n ** 3 \
+            + 6 * delta ** 2 * (na ** 2 * other.m2 + nb ** 2 * self.m2) / n ** 2 \
+            + 4 * delta * (na * other.m3 - nb * self.m3) / n
+        self.m3 += other.m3 + delta ** 3 * na * nb * (na - nb) / n ** 2 + 3 * delta * (na * other.m2 - nb * self.m2) / n
+        self.m2 += other.m2 + delta ** 2 * na * nb / n
+        for (i, j), value in self.cross.items():
+            value += other.cross[(i, j)] + delta[i] * delta[j] * na * nb / n
+        self.mean += delta * nb / n
+        self.n = n
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / self.n
+
+    @property
+    def rms(self):
+        """
+        The RMS of the fluctuations about the mean.
+        """
+        return np.sqrt(self.variance)
+
+    def covariance(self, a, b):
+        """
+        Mean of the product of the fluctuations of two fields, e.g. ('u', 'v') for -uv Reynolds stress / rho.
+        """
+        i, j = sorted((self.fields.index(a), self.fields.index(b)))
+        return self.m2[i] / self.n if i == j else self.cross[(i, j)] / self.n
+
+    @property
+    def reynolds_stresses(self):
+        """
+        Every component of the Reynolds stress tensor, e.g. {'uu': ..., 'uv': ...}, for the velocity fields held.
+        """
+        velocity = [field for field in self.fields if field in 'uvw']
+        return {a + b: self.covariance(a, b) for idx, a in enumerate(velocity) for b in velocity[idx:]}
+
+    @property
+    def skewness(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.sqrt(self.n) * self.m3 / self.m2 ** 1.5
+
+    @property
+    def flatness(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.n * self.m4 / self.m2 ** 2
+
+    def save(self, path):
+        """
+        Keep the accumulator in a .npz, to merge with other run segments later.
+        """
+        np.savez(path, fields=''.join(self.fields), n=self.n, mean=self.mean, m2=self.m2, m3=self.m3, m4=self.m4,
+                 **{f'cross_{i}_{j}': value for (i, j), value in self.cross.items()})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            stats = cls(str(saved['fields']))
+            stats.n = int(saved['n'])
+            stats.mean, stats.m2, stats.m3, stats.m4 = saved['mean'], saved['m2'], saved['m3'], saved['m4']
+            stats.cross = {tuple(int(i) for i in key.split('_')[1:]): saved[key]
+                           for key in saved.files if key.startswith('cross_')}
+        return stats
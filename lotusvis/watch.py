@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Jonathan Massey
+@description: Follow a running simulation and process each snapshot once, as it is written
+@contact: masseyjmo@gmail.com
+"""
+import copy
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+
+import lotusvis.io as io
+
+try:
+    from watchdog.observers import Observer
+except ImportError:  # Fall back to polling every interval
+    Observer = None
+
+
+class Watcher:
+    """
+    Watch the datp folder of a ReadIn and push every completed snapshot through the
+    registered pipeline, in output order and exactly once. The processed files and
+    the state of each stage can be kept in a pickle, so a restarted watcher picks up
+    where the last one stopped rather than reprocessing old output.
+
+        watcher = Watcher(ReadIn(sim_dir, 'fluid', 1), state_path='watch.pkl')
+        watcher.register('count', lambda n, snap, fn, t: n + 1, state=0)
+        watcher.run(timeout=600)
+    """
+
+    def __init__(self, sim, fields='uvwp', interval=5., settle=1., state_path=None):
+        """
+        :param sim: The ReadIn to watch.
+        :param fields: The variables each snapshot is read with.
+        :param interval: Seconds between polls of the datp folder.
+        :param settle: Seconds a snapshot's files must have been left untouched before it is read.
+        :param state_path: Pickle to keep the processed files and pipeline state in between runs.
+        """
+        self.sim = sim
+        self.fields = io.check_fields(fields)
+        self.interval = interval
+        self.settle = settle
+        self.state_path = state_path
+        self.pipeline = []
+        self.state, self.done = {}, set()
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path, 'rb') as f:
+                saved = pickle.load(f)
+            self.state, self.done = saved['state'], set(saved['done'])
+
+    def register(self, name, callback, state=None):
+        """
+        Add a stage to the end of the pipeline.
+        :param name: Key of the stage's state.
+        :param callback: Called as callback(state, snap, fn, t) with each new (1, fields, ny, nx, nz)
+                         snapshot, as next_snap yields them, its file name and output time, and
+                         returns the updated state. It is handed a copy of the state (one copy
+                         per snapshot), so it may update it in place, e.g. StreamingStats.push.
+        :param state: Initial state, ignored if the stage was restored from state_path.
+        """
+        self.pipeline.append((name, callback))
+        self.state.setdefault(name, state)
+
+    def pending(self):
+        """
+        Rescan the datp folder for completed snapshots that have not been processed.
+        :return: The file names, in output order.
+        """
+        self.sim.refresh_index()
+        ready = []
+        for fn in self.sim.fns:
+            if fn in self.done:
+                continue
+            path = os.path.join(self.sim.datp_dir, fn)
+            if io.snapshot_complete(path) and time.time() - io.snapshot_stat(path)[1] >= self.settle:
+                ready.append(fn)
+        return ready
+
+    def process(self, fn):
+        """
+        Read one snapshot and run it through every stage of the pipeline. The new states
+        are only kept, and fn marked done, once every stage has succeeded, so a stage that
+        raises leaves the snapshot to be processed again from the old states.
+        """
+        snap = self.sim.read_snap(fn, self.fields)[None]
+        t = self.sim.times[self.sim.fns.index(fn)] if fn in self.sim.fns else np.nan
+        state = dict(self.state)
+        for name, callback in self.pipeline:
+            state[name] = callback(copy.deepcopy(state[name]), snap, fn, t)
+        self.state = state
+        self.done.add(fn)
+
+    def poll(self):
+        """
+        Process everything that has been completed since the last poll.
+        :return: The file names processed.
+        """
+        fns, processed = self.pending(), []
+        try:
+            for fn in fns:
+                self.process(fn)
+                processed.append(fn)
+        finally:
+            if processed:
+                self.save()
+        return processed
+
+    def save(self):
+        if self.state_path is None:
+            return
+        tmp = f'{self.state_path}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'state': self.state, 'done': sorted(self.done)}, f)
+        os.replace(tmp, self.state_path)
+
+    def run(self, timeout=None, until=None):
+        """
+        Keep polling, waking early on file events when watchdog is installed.
+        :param timeout: Stop after this many seconds without a new snapshot, never if None.
+        :param until: Optional until(state) checked after each poll, stop when it returns True.
+        :return: The pipeline state.
+        """
+        wake = threading.Event()
+        observer = None
+        if Observer is not None:
+            observer = Observer()
+            observer.schedule(_Wake(wake), self.sim.datp_dir)
+            observer.start()
+        idle = time.monotonic()
+        try:
+            while True:
+                if self.poll():
+                    idle = time.monotonic()
+                if until is not None and until(self.state):
+                    break
+                if timeout is not None and time.monotonic() - idle >= timeout:
+                    break
+                wake.wait(self.interval)
+                wake.clear()
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+        return self.state
+
+
+class _Wake:
+
+    """Minimal watchdog handler that wakes the poll loop on any change."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def dispatch(self, event):
+        self.event.set()
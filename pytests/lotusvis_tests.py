@@ -1,7 +1,17 @@
 import unittest
-from os
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import lotusvis.io as io
+from lotusvis import blocked, kernels, logs, parallel
+from lotusvis.decompositions import Decompositions, instantaneous_phase
 from lotusvis.assign_props import AssignProps
 from lotusvis.flow_field import ReadIn
+from lotusvis.statistics import StreamingStats
+from lotusvis.watch import Watcher
 
 
 def func(x):
@@ -24,6 +34,43 @@ def norms(snaps):
     return nx
 
 
+def write_vtr(sim_dir, x, y, z, pieces, fields):
+    """
+    Write a stretched grid as a Lotus-style .pvtr with raw appended .vtr pieces.
+    :param pieces: (i0, i1, j0, j1, k0, k1) index extent of each piece.
+    :param fields: (4, ny, nx, nz) u, v, w and p on the whole grid.
+    """
+    os.makedirs(f"{sim_dir}/datp")
+    sources = []
+    for rank, (i0, i1, j0, j1, k0, k1) in enumerate(pieces):
+        os.makedirs(f"{sim_dir}/dat{rank}")
+        extent = f"{i0} {i1} {j0} {j1} {k0} {k1}"
+        piece = fields[:, j0:j1 + 1, i0:i1 + 1, k0:k1 + 1]
+        blocks = [piece[:3].transpose(3, 1, 2, 0).astype('<f4').tobytes(),
+                  piece[3].transpose(2, 0, 1).astype('<f4').tobytes(),
+                  x[i0:i1 + 1].astype('<f4').tobytes(), y[j0:j1 + 1].astype('<f4').tobytes(),
+                  z[k0:k1 + 1].astype('<f4').tobytes()]
+        offsets = np.cumsum([0] + [4 + len(block) for block in blocks])
+        head = (f'<VTKFile type="RectilinearGrid" version="0.1" byte_order="LittleEndian">\n'
+                f'<RectilinearGrid WholeExtent="{extent}">\n<Piece Extent="{extent}">\n<PointData>\n'
+                f'<DataArray type="Float32" Name="Velocity" NumberOfComponents="3" format="appended" offset="{offsets[0]}"/>\n'
+                f'<DataArray type="Float32" Name="Pressure" format="appended" offset="{offsets[1]}"/>\n'
+                '</PointData>\n<Coordinates>\n'
+                + ''.join(f'<DataArray type="Float32" format="appended" offset="{offset}"/>\n' for offset in offsets[2:5])
+                + '</Coordinates>\n</Piece>\n</RectilinearGrid>\n<AppendedData encoding="raw">\n_')
+        with open(f"{sim_dir}/dat{rank}/fluid.1.vtr", 'wb') as f:
+            f.write(head.encode() + b''.join(np.uint32(len(block)).tobytes() + block for block in blocks)
+                    + b'\n</AppendedData>\n</VTKFile>\n')
+        sources.append(f'<Piece Extent="{extent}" Source="../dat{rank}/fluid.1.vtr"/>\n')
+    with open(f"{sim_dir}/datp/fluid.1.pvtr", 'w') as f:
+        f.write(f'<VTKFile type="PRectilinearGrid" version="0.1" byte_order="LittleEndian">\n'
+                f'<PRectilinearGrid WholeExtent="0 {len(x) - 2} 0 {len(y) - 1} 0 {len(z) - 1}" GhostLevel="0">\n'
+                '<PPointData>\n<PDataArray type="Float32" Name="Velocity" NumberOfComponents="3"/>\n'
+                '<PDataArray type="Float32" Name="Pressure"/>\n</PPointData>\n<PCoordinates>\n'
+                + '<PDataArray type="Float32"/>\n' * 3 + '</PCoordinates>\n' + ''.join(sources)
+                + '</PRectilinearGrid>\n</VTKFile>\n')
+
+
 class TestIO(unittest.TestCase):
 
     def test_func(self):
@@ -38,6 +85,482 @@ class TestIO(unittest.TestCase):
     def test_norms(self):
         self.assertTrue(norms(read(f"{os.getcwd()}/pytests/test_data")).shape  == (97,))
 
+    def test_pieces(self):
+        test_data = f"{os.getcwd()}/pytests/test_data"
+        snap = io.read_vti(f"{test_data}/datp/fluid.0.pvti", 4096)
+        piece = io.read_vti(f"{test_data}/dat1x1x0/fluid.0.vti", 4096)
+        # The last rank piece carries one plane past the whole extent
+        self.assertTrue(np.array_equal(snap[:, 51:, 60:], piece[:, :-1, :-1]))
+
+    def test_threaded_pieces(self):
+        fn = f"{os.getcwd()}/pytests/test_data/datp/fluid.3.pvti"
+        self.assertTrue(np.array_equal(io.read_vti(fn, 4096, workers=1), io.read_vti(fn, 4096, workers=4)))
+
+    def test_fields(self):
+        fn = f"{os.getcwd()}/pytests/test_data/datp/fluid.3.pvti"
+        snap = io.read_vti(fn, 4096)
+        self.assertTrue(np.array_equal(io.read_vti(fn, 4096, fields='p'), snap[3:]))
+        self.assertTrue(np.array_equal(io.read_vti(fn, 4096, fields=('v', 'u')), snap[[1, 0]]))
+
+    def test_window(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1, window=((-60, 100), (-100, 0)))
+        snap = sim.read_snap(sim.fns[3])
+        x, y, _ = sim.grid()
+        self.assertTrue(snap.shape == (4, len(y), len(x), 1))
+        self.assertTrue(x[0] <= -60 and x[-1] >= 100 and y[0] <= -100 and y[-1] >= 0)
+        self.assertTrue(np.array_equal(snap, io.read_vti(os.path.join(sim.datp_dir, sim.fns[3]), 1)[:, :52, :42]))
+
+    def test_prefetch(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 4096)
+        prefetched = list(sim.next_snap(fields='p', prefetch=3))
+        self.assertTrue(len(prefetched) == len(sim.fns))
+        for snap, fn in zip(prefetched, sim.fns):
+            self.assertTrue(np.array_equal(snap[0], sim.read_snap(fn, fields='p')))
+        # Leaving early shuts the workers down
+        with sim.prefetch_snaps(depth=2) as snaps:
+            next(snaps)
+        self.assertTrue(not snaps.queue)
+
+    def test_index(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 4096)
+        self.assertTrue(sim.fns == [f"fluid.{n}.pvti" for n in range(20)])
+        self.assertTrue(np.isclose(sim.times[0], 430.18203735) and np.all(np.diff(sim.times) > 0))
+        self.assertTrue(sim.init_snap_array() == (20, 4, 103, 97, 1))
+        self.assertTrue(sim.init_snap_array(fields='p') == (20, 1, 103, 97, 1))
+
+    def test_time_access(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 4096)
+        self.assertTrue(sim.nearest_snap(0) == "fluid.0.pvti" and sim.nearest_snap(1e4) == "fluid.19.pvti")
+        self.assertTrue(sim.nearest_snap([438, 445]) == ["fluid.1.pvti", "fluid.2.pvti"])
+        self.assertTrue(sim.snaps_between(437, 455) == ["fluid.1.pvti", "fluid.2.pvti", "fluid.3.pvti"])
+        self.assertTrue(sim.snaps_every(50) == [f"fluid.{n}.pvti" for n in (0, 6, 12, 18)])
+        sim.fns = sim.snaps_between(500, np.inf)
+        self.assertTrue(sim.fns[0] == "fluid.9.pvti" and sim.times[0] > 500)
+
+    def test_store(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1)
+        fn = os.path.join(sim.datp_dir, sim.fns[5])
+        with tempfile.TemporaryDirectory() as save_path:
+            store = sim.store(save_path)
+            self.assertTrue(len(store) == len(sim.fns))
+            self.assertTrue(np.array_equal(store.read(5), io.read_vti(fn, 1)))
+            slab = store.read(slice(2, 6), fields='p', region=store.region(window=((-60, 100), (-100, 0))))
+            self.assertTrue(slab.shape == (4, 1, 52, 42, 1))
+            self.assertTrue(np.array_equal(slab[3, 0], io.read_vti(fn, 1, fields='p')[0, :52, :42]))
+            store.close()
+
+    def test_compressed_store(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1)
+        snaps = sim.snaps(save=False, part=False)
+        with tempfile.TemporaryDirectory() as save_path:
+            store = sim.store(save_path, compressed=True)
+            self.assertTrue(np.array_equal(store.read(), snaps))
+            self.assertTrue(np.array_equal(sim.read_snap(sim.fns[7], fields='wp'), snaps[7, 2:]))
+            store.close()
+        with tempfile.TemporaryDirectory() as save_path:
+            lossy = sim.store(save_path, compressed=True, tolerance=1e-3, level=1)
+            error = np.abs(lossy.read() - snaps).max()
+            self.assertTrue(0 < error <= 1e-3 + 1e-6)
+            lossy.close()
+
+    def test_stream(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1)
+        snaps = sim.snaps(save=False, part=False)
+        with tempfile.TemporaryDirectory() as save_path:
+            streamed = sim.snaps(part=False, save_path=save_path, stream=True)
+            self.assertTrue(isinstance(streamed, np.memmap) and np.array_equal(streamed, snaps))
+            sdf = sim.save_sdf(save_path)
+            self.assertTrue(np.array_equal(sdf, snaps[:, 3]) and os.path.exists(f"{save_path}/fluid_p.npy"))
+            sim.fns = []
+            self.assertTrue(sim.stream_snaps(f"{save_path}/empty.npy").shape == (0, 4, 103, 97, 1))
+
+    def test_watch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sim_dir = shutil.copytree(f"{os.getcwd()}/pytests/test_data", f"{tmp}/sim")
+            sim = ReadIn(sim_dir, "fluid", 1, use_store=False)
+            last = sim.fns[-1]
+            piece = io.read_pvti_header(f"{sim_dir}/datp/{last}")['pieces'][0][1]
+            with open(piece, 'rb') as f:
+                data = f.read()
+            with open(piece, 'wb') as f:
+                f.write(data[:len(data) // 2])
+
+            state_path = f"{tmp}/watch.pkl"
+            watcher = Watcher(sim, fields='p', settle=0., state_path=state_path)
+            watcher.register('sum', lambda total, snap, fn, t: total + snap.sum(dtype=np.float64), state=0.)
+            watcher.register('shapes', lambda shapes, snap, fn, t: shapes | {snap.shape}, state=set())
+            self.assertTrue(watcher.poll() == sim.fns[:-1] and watcher.poll() == [])
+            self.assertTrue(watcher.state['shapes'] == {(1,) + sim.init_snap_array('p')[1:]})
+
+            with open(piece, 'wb') as f:
+                f.write(data)
+            restarted = Watcher(sim, fields='p', settle=0., state_path=state_path)
+            restarted.register('sum', lambda total, snap, fn, t: total + snap.sum(dtype=np.float64), state=0.)
+            restarted.register('stats', lambda stats, snap, fn, t: stats.push(snap[0]), state=StreamingStats('p'))
+
+            def fail_once(failed, snap, fn, t):
+                if not failed:
+                    raise RuntimeError('a later stage failed')
+                return failed
+
+            # A stage that raises leaves the earlier stages as they were, to take the snapshot again
+            restarted.register('fail_once', fail_once, state=False)
+            with self.assertRaises(RuntimeError):
+                restarted.poll()
+            self.assertTrue(last not in restarted.done and restarted.state['stats'].n == 0)
+            restarted.state['fail_once'] = True
+            self.assertTrue(restarted.poll() == [last])
+            expected = sum(sim.read_snap(fn, 'p').sum(dtype=np.float64) for fn in sim.fns)
+            self.assertTrue(np.isclose(restarted.state['sum'], expected) and restarted.state['stats'].n == 1)
+            self.assertTrue(np.allclose(restarted.state['stats'].mean, sim.read_snap(last, 'p')))
+
+    def test_vorticity_savers(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 4096)
+        sim.fns = sim.fns[:2]
+        with tempfile.TemporaryDirectory() as save_path:
+            streamed = sim.save_vorticity_field(save_path)
+            sim.vort_low_memory_saver(save_path)
+            for idx in range(2):
+                self.assertTrue(np.allclose(np.load(f"{save_path}/fluid_vortz{idx}.npy")[0], streamed[idx]))
+
+    def test_vtr(self):
+        x = np.concatenate((np.arange(8.), 8 + np.cumsum(1.2 ** np.arange(1, 8))))
+        y = np.linspace(-4., 4., 9)
+        X, Y = np.meshgrid(x, y)
+        fields = np.array((X ** 2, X * Y, np.zeros_like(X), Y))
+        with tempfile.TemporaryDirectory() as sim_dir:
+            # Two pieces sharing the plane at i=8, the last one a plane past the whole extent
+            write_vtr(sim_dir, x, y, np.zeros(1), [(0, 8, 0, 8, 0, 0), (8, len(x) - 1, 0, 8, 0, 0)], fields[..., None])
+            snap, (gx, gy, gz) = io.read_vtr(f"{sim_dir}/datp/fluid.1.pvtr", 2, workers=2)
+            self.assertTrue(np.array_equal(snap[..., 0], fields[:, :, :-1].astype(np.float32)))
+            self.assertTrue(np.allclose(gx, x[:-1] / 2) and np.allclose(gy, y / 2))
+            # A single piece is cropped to the window too
+            whole, (wx, _, _) = io.read_vtr(f"{sim_dir}/dat1/fluid.1.vtr", 2)
+            piece, (px, _, _) = io.read_vtr(f"{sim_dir}/dat1/fluid.1.vtr", 2, window=((5, 6), None))
+            kept = (wx >= px[0]) & (wx <= px[-1])
+            self.assertTrue(px[0] <= 5 < 6 <= px[-1] and len(px) < len(wx))
+            self.assertTrue(np.array_equal(piece, whole[:, :, kept]))
+
+            sim = ReadIn(sim_dir, "fluid", 2, ext='vtr', window=((1, 5), None))
+            sub = sim.read_snap(sim.fns[0], 'up')
+            gx, gy, _ = sim.grid()
+            self.assertTrue(gx[0] <= 1 and gx[-1] >= 5 and np.allclose(sub[0, ..., 0], (2 * gx) ** 2))
+            props = AssignProps(sim.read_snap(sim.fns[0])[None], 2, sim.grid())
+            # Quadratics are differentiated exactly even where the grid stretches
+            self.assertTrue(np.allclose(props.dudx[0, ..., 0], 2 * (2 * gx), rtol=1e-4))
+            self.assertTrue(np.allclose(props.dvdy[0, ..., 0], np.broadcast_to(2 * gx, sub[0, ..., 0].shape), rtol=1e-4))
+
+    def test_logs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sim_dir = shutil.copytree(f"{os.getcwd()}/pytests/test_data", f"{tmp}/sim")
+            forces = logs.force_history(sim_dir)
+            self.assertTrue(np.array_equal(forces['c0'], np.loadtxt(f"{sim_dir}/fort.9")[:, 2]))
+            self.assertTrue(logs.solver_log(sim_dir)['iterations'].dtype == np.int64)
+            self.assertTrue(logs.mpi_timings(sim_dir).data.dtype.names[-1] == 'total')
+
+            # A half written line waits for the rest of it
+            row = b"    7.0100  1.7800" + b"  0.10000000E+01" * 12 + b"\n"
+            with open(f"{sim_dir}/fort.9", 'ab') as f:
+                f.write(row[:20])
+            self.assertTrue(len(forces.refresh()) == 0)
+            with open(f"{sim_dir}/fort.9", 'ab') as f:
+                f.write(row[20:])
+            self.assertTrue(len(forces.refresh()) == 1 and forces['t'][-1] == 7.01)
+            # The cache is picked up with nothing left to parse
+            cached = logs.force_history(sim_dir)
+            self.assertTrue(len(cached.refresh()) == 0 and np.array_equal(cached.data, forces.data))
+
+            # A run that has only written its headers so far
+            with open(f"{sim_dir}/mpi.csv") as f:
+                header, first = f.readline(), f.readline()
+            with open(f"{sim_dir}/mpi.csv", 'w') as f:
+                f.write(header)
+            open(f"{sim_dir}/fort.8", 'w').close()
+            timings = logs.mpi_timings(sim_dir)
+            self.assertTrue(len(timings) == 0 and len(logs.solver_log(sim_dir)) == 0)
+            self.assertTrue(timings.data.dtype.names == tuple(name.strip() for name in header.split(',')))
+            with open(f"{sim_dir}/mpi.csv", 'a') as f:
+                f.write(first)
+            self.assertTrue(len(timings.refresh()) == 1 and len(logs.mpi_timings(sim_dir)) == 1)
+
+            sim = ReadIn(sim_dir, "fluid", 1, use_store=False)
+            aligned = sim.forces(time_scale=100)
+            self.assertTrue(np.allclose(aligned['c1'], np.interp(sim.times, forces['t'] * 100, forces['c1'])))
+            self.assertTrue(np.isnan(sim.forces(time_scale=1)['c1']).all())
+
+    def test_span(self):
+        x, y, z = np.arange(13.), np.arange(9.), np.linspace(0, 1, 8)
+        fields = np.random.default_rng(1).random((4, len(y), len(x), len(z)))
+        with tempfile.TemporaryDirectory() as sim_dir:
+            # Pieces split along every axis, sharing their boundary planes
+            pieces = [(i0, i1, j0, j1, k0, k1) for i0, i1 in ((0, 6), (6, 12)) for j0, j1 in ((0, 4), (4, 8))
+                      for k0, k1 in ((0, 3), (3, 7))]
+            write_vtr(sim_dir, x, y, z, pieces, fields)
+            sim = ReadIn(sim_dir, "fluid", 1, ext='vtr')
+            snap = sim.read_snap(sim.fns[0]).astype(np.float64)
+            mean, rms = sim.read_span(sim.fns[0], rms=True)
+            self.assertTrue(mean.shape == snap.shape[:-1] and np.allclose(mean, snap.mean(axis=-1), atol=1e-6))
+            self.assertTrue(np.allclose(rms, snap.std(axis=-1), atol=1e-5))
+            self.assertTrue(np.allclose(next(sim.span_snaps('p')), mean[3:], atol=1e-6))
+
+    def test_stride(self):
+        fn = f"{os.getcwd()}/pytests/test_data/datp/fluid.1.pvti"
+        full = io.read_vti(fn, 1)
+        for stride in ((3, 2, 1), (5, 7, 1), 4):
+            sx, sy, _ = io.check_stride(stride)
+            self.assertTrue(np.array_equal(io.read_vti(fn, 1, stride=stride), full[:, ::sy, ::sx]))
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1, window=((-50, 200), (-40, 60)), stride=(3, 2))
+        windowed = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1, window=((-50, 200), (-40, 60)), use_store=False)
+        x, y, _ = sim.grid()
+        wx, wy, _ = windowed.grid()
+        self.assertTrue(np.allclose(np.diff(x), 3 * 4) and np.allclose(x, wx[::3]) and np.allclose(y, wy[::2]))
+        snap = sim.read_snap(sim.fns[0])
+        self.assertTrue(np.array_equal(snap, windowed.read_snap(windowed.fns[0])[:, ::2, ::3]))
+        self.assertTrue(snap.shape[1:] == sim.init_snap_array()[2:])
+        with tempfile.TemporaryDirectory() as save_path:
+            for compressed in (False, True):
+                # Stores are written at full resolution and decimated on read
+                store = sim.store(save_path, compressed=compressed)
+                self.assertTrue(store.shape[1:] == io.extent_shape(sim.extent()))
+                self.assertTrue(np.array_equal(sim.read_snap(sim.fns[0]), snap))
+            store.close()
+
+    def test_gradient_cache(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1, use_store=False)
+        snaps = sim.snaps(save=False, part=False)[:3]
+        props = AssignProps(snaps, 1, sim.grid())
+        x, y, _ = sim.grid()
+        dvdx = np.gradient(snaps[:, 1], x, axis=2, edge_order=2)
+        dudy = np.gradient(snaps[:, 0], y, axis=1, edge_order=2)
+        self.assertTrue(np.allclose(props.vorticity_z, dvdx - dudy))
+        self.assertTrue(props.vorticity_z is not None and props.dvdx is props.velocity_gradient(1, 0))
+        self.assertTrue(props.gradient_tensor.shape == (3, 3) + snaps[:, 0].shape and not props.vorticity_x.any())
+        # Replacing a component only drops the gradients taken from it
+        props.U = 2 * props.U
+        self.assertTrue((1, 0) in props._gradients and (0, 1) not in props._gradients)
+        self.assertTrue(np.allclose(props.vorticity_z, dvdx - 2 * dudy))
+
+    def test_vortex_criteria(self):
+        axis = np.linspace(-1, 1, 7)
+        y, x, z = np.meshgrid(axis, axis, axis, indexing='ij')
+        # Solid body rotation about z plus a little straining along it
+        snap = np.array((-y, x, 0.1 * z, np.zeros_like(x)))[None]
+        props = AssignProps(snap, 1, (axis, axis, axis))
+        self.assertTrue(np.allclose(props.q_criterion, 1 - 0.01 / 2))
+        self.assertTrue(np.allclose(props.lambda2, -1) and np.allclose(props.swirling_strength, 1))
+
+        rng = np.random.default_rng(0)
+        props = AssignProps(rng.standard_normal((2, 4, 5, 6, 7)), 1)
+        tensors = np.moveaxis(props.gradient_tensor, (0, 1), (-2, -1)).reshape(-1, 3, 3)
+        strain, rotation = (tensors + tensors.swapaxes(1, 2)) / 2, (tensors - tensors.swapaxes(1, 2)) / 2
+        q = ((rotation ** 2).sum(axis=(1, 2)) - (strain ** 2).sum(axis=(1, 2))) / 2
+        self.assertTrue(props.q_criterion.shape == props.U.shape and np.allclose(props.q_criterion.ravel(), q))
+        lambda2 = [np.linalg.eigvalsh(s @ s + r @ r)[1] for s, r in zip(strain, rotation)]
+        self.assertTrue(np.allclose(props.lambda2.ravel(), lambda2))
+        self.assertTrue(np.array_equal(props.pointwise(lambda t: t[:, 0, 1], block=7), props.dudy))
+        self.assertTrue(np.allclose(props.swirling_strength.ravel(), [np.linalg.eigvals(t).imag.max() for t in tensors]))
+
+    def test_kernels(self):
+        snaps = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1, use_store=False).snaps(save=False, part=False)[:4]
+        props = AssignProps(snaps, 1)
+        u, v, w = snaps[:, 0], snaps[:, 1], snaps[:, 2]
+        magnitude = props.magnitude
+        self.assertTrue(magnitude.dtype == np.float32 and np.allclose(magnitude, np.sqrt(u ** 2 + v ** 2 + w ** 2)))
+        numexpr, kernels.numexpr = kernels.numexpr, None
+        try:
+            out = np.empty_like(u)
+            blocked = kernels.evaluate('sqrt(u**2 + v**2 + w**2)', out=out, block=500, u=u, v=v, w=w)
+            self.assertTrue(blocked is out and np.allclose(blocked, magnitude))
+        finally:
+            kernels.numexpr = numexpr
+
+    def test_blocked(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1, use_store=False)
+        with tempfile.TemporaryDirectory() as save_path:
+            snaps = sim.stream_snaps(f"{save_path}/fluid.npy")
+            whole = AssignProps(np.array(snaps), 1, sim.grid()).vorticity_z
+            # Small enough to split every snapshot into slabs
+            vort = sim.derived_field('vorticity_z', f"{save_path}/vortz.npy", snaps, nbytes=2 ** 16)
+            self.assertTrue(isinstance(vort, np.memmap) and np.allclose(vort, whole, rtol=1e-6, atol=1e-6))
+            stored = sim.derived_field('vorticity_z', snaps=sim.store(save_path), nbytes=2 ** 20)
+            self.assertTrue(np.allclose(stored, whole, rtol=1e-6, atol=1e-6))
+            sim.snap_store.close()
+
+        with tempfile.TemporaryDirectory() as sim_dir:
+            shutil.copytree(f"{os.getcwd()}/pytests/test_data", sim_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns('bodyF*', 'fluid.1?.*', 'lotus*', '*.pdf'))
+            ReadIn(sim_dir, "fluid", 1).store().close()
+            # A windowed and strided ReadIn over the full store, and over the arrays it reads itself
+            sim = ReadIn(sim_dir, "fluid", 1, window=((-60, 100), (-100, 0)), stride=2)
+            whole = AssignProps(sim.snaps(save=False, part=False), 1, sim.grid()).vorticity_z
+            stored = sim.derived_field('vorticity_z', nbytes=2 ** 14)
+            self.assertTrue(stored.shape == whole.shape and np.allclose(stored, whole, rtol=1e-6, atol=1e-6))
+            sim.snap_store.close()
+            sim = ReadIn(sim_dir, "fluid", 1, stride=2, use_store=False)
+            streamed = sim.derived_field('vorticity_z', snaps=sim.stream_snaps(f"{sim_dir}/fluid.npy"))
+            whole = AssignProps(sim.snaps(save=False, part=False), 1, sim.grid()).vorticity_z
+            self.assertTrue(np.allclose(streamed, whole, rtol=1e-6, atol=1e-6))
+
+        rng = np.random.default_rng(2)
+        snaps = rng.standard_normal((2, 4, 9, 11, 13))
+        axes = tuple(np.cumsum(rng.random(n) + 0.5) for n in (11, 9, 13))
+        expected = AssignProps(snaps, 1, axes).q_criterion
+        for nbytes in (2 ** 14, 2 ** 16, 2 ** 30):
+            self.assertTrue(np.allclose(blocked.derived_field(snaps, 'q_criterion', axes=axes, nbytes=nbytes), expected))
+
+    def test_parallel(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1, use_store=False)
+        expected = AssignProps(sim.snaps(save=False, part=False), 1, sim.grid()).vorticity_z
+        with tempfile.TemporaryDirectory() as save_path:
+            vort = sim.derived_snaps('vorticity_z', f"{save_path}/vortz.npy", workers=2)
+            self.assertTrue(vort.shape == expected.shape and np.allclose(vort, expected, rtol=1e-6, atol=1e-6))
+            # A budget too small for a slot per worker still gets one slot through
+            vort = parallel.derived_fields(sim, 'vorticity_z', f"{save_path}/vortz.npy", workers=2, nbytes=1)
+            self.assertTrue(np.allclose(vort, expected, rtol=1e-6, atol=1e-6))
+            # Workers start clean, so the thread pools live here (and the NumPy fallback) are no trouble
+            numexpr, kernels.numexpr = kernels.numexpr, None
+            try:
+                io.piece_pool()
+                vort = sim.derived_snaps('vorticity_z', f"{save_path}/vortz.npy", workers=2)
+                self.assertTrue(np.allclose(vort, expected, rtol=1e-6, atol=1e-6))
+            finally:
+                kernels.numexpr = numexpr
+
+    def test_statistics(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 1, use_store=False)
+        snaps = sim.snaps(save=False, part=False).astype(np.float64)
+        stats = sim.statistics()
+        fluctuations = snaps - snaps.mean(axis=0)
+        self.assertTrue(stats.n == len(snaps) and np.allclose(stats.mean, snaps.mean(axis=0)))
+        self.assertTrue(np.allclose(stats.rms, snaps.std(axis=0)))
+        self.assertTrue(np.allclose(stats.reynolds_stresses['uv'], (fluctuations[:, 0] * fluctuations[:, 1]).mean(axis=0)))
+        # Only where the field varies, w is zero throughout a 2D run
+        varies = snaps.std(axis=0) > 1e-6
+        skewness = (fluctuations ** 3).mean(axis=0)[varies] / snaps.std(axis=0)[varies] ** 3
+        flatness = (fluctuations ** 4).mean(axis=0)[varies] / snaps.std(axis=0)[varies] ** 4
+        self.assertTrue(np.allclose(stats.skewness[varies], skewness) and np.allclose(stats.flatness[varies], flatness))
+
+        # Segments accumulated apart (in batches or one by one) merge to the same statistics
+        merged = StreamingStats().push(snaps[:7]).merge(sim.statistics(workers=3))
+        whole = StreamingStats().push(snaps[:7]).push(snaps)
+        for moment in ('mean', 'm2', 'm3', 'm4'):
+            self.assertTrue(np.allclose(getattr(merged, moment), getattr(whole, moment)))
+        self.assertTrue(np.allclose(merged.cross[(0, 2)], whole.cross[(0, 2)]))
+        with tempfile.TemporaryDirectory() as save_path:
+            stats.save(f"{save_path}/stats.npz")
+            loaded = StreamingStats.load(f"{save_path}/stats.npz")
+            self.assertTrue(loaded.fields == stats.fields and np.array_equal(loaded.cross[(1, 3)], stats.cross[(1, 3)]))
+
+        self.assertTrue(np.allclose(sim.time_avg(), snaps.mean(axis=0)))
+        self.assertTrue(np.allclose(sim.rms(), np.sqrt(snaps[:, :3].var(axis=0).sum(axis=0))[..., 0]))
+
+    def test_refresh_store(self):
+        with tempfile.TemporaryDirectory() as sim_dir:
+            shutil.copytree(f"{os.getcwd()}/pytests/test_data", sim_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns('bodyF*', 'fluid.1?.*', 'lotus*', '*.pdf'))
+            sim = ReadIn(sim_dir, "fluid", 1)
+            self.assertTrue(len(sim.store()) == 10)
+            for fn in os.listdir(f"{os.getcwd()}/pytests/test_data/datp"):
+                if fn.startswith("fluid.1") and len(fn) == len("fluid.10.pvti"):
+                    shutil.copy(f"{os.getcwd()}/pytests/test_data/datp/{fn}", sim.datp_dir)
+            for piece in ("dat0x0x0", "dat0x1x0", "dat1x0x0", "dat1x1x0"):
+                shutil.copytree(f"{os.getcwd()}/pytests/test_data/{piece}", f"{sim_dir}/{piece}", dirs_exist_ok=True)
+            os.utime(os.path.join(sim_dir, "dat1x0x0", "fluid.3.vti"))
+            stale = sim.refresh_store(sim.store_path())
+            self.assertTrue(sorted(stale) == sorted(["fluid.3.pvti"] + [f"fluid.{n}.pvti" for n in range(10, 20)]))
+            self.assertTrue(sim.refresh_store(sim.store_path()) == [])
+            store = sim.store()
+            self.assertTrue(len(store) == 20)
+            self.assertTrue(np.array_equal(store.read(store.index["fluid.15.pvti"]), sim.read_source("fluid.15.pvti")))
+            store.close()
+
+    def test_refresh_windowed_store(self):
+        with tempfile.TemporaryDirectory() as sim_dir:
+            shutil.copytree(f"{os.getcwd()}/pytests/test_data", sim_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns('bodyF*', 'fluid.1?.*', 'lotus*', '*.pdf'))
+            window = ((-60, 100), (-100, 0))
+            ReadIn(sim_dir, "fluid", 1, window=window).store().close()
+            shifted = ReadIn(sim_dir, "fluid", 1, window=((-56, 104), (-100, 0)), use_store=False)
+            os.utime(os.path.join(sim_dir, "dat0x0x0", "fluid.3.vti"))
+            self.assertTrue(shifted.refresh_store(shifted.store_path()) == ["fluid.3.pvti"])
+            # The store is refreshed over its own extent, not the shifted window
+            sim = ReadIn(sim_dir, "fluid", 1, window=window)
+            self.assertTrue(np.array_equal(sim.read_snap("fluid.3.pvti"), sim.read_source("fluid.3.pvti")))
+            sim.snap_store.close()
+            with self.assertRaises(ValueError):
+                shifted.store()
+
+    def test_windowed_snaps(self):
+        with tempfile.TemporaryDirectory() as sim_dir:
+            shutil.copytree(f"{os.getcwd()}/pytests/test_data", sim_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns('bodyF*', 'fluid.1?.*', 'lotus*', '*.pdf'))
+            ReadIn(sim_dir, "fluid", 1).store().close()
+            # A full store serves a window through the region it was attached with
+            sim = ReadIn(sim_dir, "fluid", 1, window=((-60, 100), (-100, 0)))
+            stored = sim.snaps(part=False)
+            self.assertTrue(stored.shape == sim.init_snap_array())
+            self.assertTrue(np.array_equal(stored, sim.snaps(save=False, part=False)))
+            sim.snap_store.close()
+            # and a stride too
+            sim = ReadIn(sim_dir, "fluid", 1, window=((-60, 100), (-100, 0)), stride=2)
+            stored = sim.snaps(part=False)
+            self.assertTrue(stored.shape == sim.init_snap_array() == (10, 4, 26, 21, 1))
+            self.assertTrue(np.array_equal(stored, sim.snaps(save=False, part=False)))
+            sim.snap_store.close()
+
+    def test_partial_store(self):
+        with tempfile.TemporaryDirectory() as sim_dir:
+            shutil.copytree(f"{os.getcwd()}/pytests/test_data", sim_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns('bodyF*', 'fluid.1?.*', 'lotus*', '*.pdf'))
+            ReadIn(sim_dir, "fluid", 1).store(fields='p').close()
+            sim = ReadIn(sim_dir, "fluid", 1)
+            # The pressure comes from the store, the velocity the store doesn't hold from the pieces
+            self.assertTrue(sim.snap_store is not None and sim.snap_store.fields == ('p',))
+            self.assertTrue(np.array_equal(sim.read_snap(sim.fns[2]), sim.read_source(sim.fns[2])))
+            self.assertTrue(np.array_equal(sim.read_snap(sim.fns[2], 'p'), sim.read_source(sim.fns[2], 'p')))
+            self.assertTrue(len(list(sim.next_snap())) == 10)
+            sim.snap_store.close()
+
+    def test_phase_average(self):
+        sim = Decompositions(f"{os.getcwd()}/pytests/test_data", "fluid", 4096)
+        phase = sim.phase_average(2)
+        expected = np.mean([sim.read_snap(fn) for fn in sim.fns[::10]], axis=0)
+        self.assertTrue(np.allclose(phase[0], expected))
+        self.assertTrue(phase.dtype == np.float32)
+
+    def test_phase_bins(self):
+        sim = Decompositions(f"{os.getcwd()}/pytests/test_data", "fluid", 4096)
+        bins = sim.phase_bins(33., 4)
+        self.assertTrue(np.array_equal(bins, (np.mod((sim.times - sim.times[0]) / 33., 1) * 4).astype(int)))
+        phase = sim.phase_average(period=33., n_bins=4, fields='up', workers=3)
+        expected = np.mean([sim.read_snap(fn, 'up') for fn, b in zip(sim.fns, bins) if b == 3], axis=0)
+        self.assertTrue(phase.shape == (4, 2) + expected.shape[1:])
+        self.assertTrue(np.allclose(phase[3], expected, atol=1e-6))
+        self.assertTrue(np.allclose(phase, sim.phase_average(period=33., n_bins=4, fields='up'), atol=1e-6))
+
+    def test_force_phase(self):
+        # A period that drifts is followed by both methods
+        t = np.sort(np.random.default_rng(0).uniform(0, 10, 2000))
+        cycles = t / 1.3 + 0.02 * t ** 2
+        for method in ('hilbert', 'crossings'):
+            phase = instantaneous_phase(t, np.sin(2 * np.pi * cycles), method)
+            inner = np.isfinite(phase) & (t > 1) & (t < 9)
+            self.assertTrue(np.abs(phase[inner] - cycles[inner]).max() < 0.02)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            sim_dir = shutil.copytree(f"{os.getcwd()}/pytests/test_data", f"{tmp}/sim")
+            sim = Decompositions(sim_dir, "fluid", 4096)
+            bins = sim.force_phase_bins('c1', 4, 'crossings', time_scale=84.5)
+            # Snapshots past the last crossing are left out
+            self.assertTrue(bins[-1] == -1 and (bins[:3] >= 0).all())
+            phase = sim.phase_average(n_bins=4, fields='p', workers=2, force='c1', method='crossings', time_scale=84.5)
+            expected = np.mean([sim.read_snap(fn, 'p') for fn, b in zip(sim.fns, bins) if b == bins[0]], axis=0)
+            self.assertTrue(np.allclose(phase[bins[0]], expected, atol=1e-6))
+
+    def test_float32(self):
+        sim = ReadIn(f"{os.getcwd()}/pytests/test_data", "fluid", 4096)
+        self.assertTrue(sim.snaps(save=False, part=False).dtype == np.float32)
+
 if __name__ == '__main__':
     unittest.main()
 